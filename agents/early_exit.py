@@ -0,0 +1,133 @@
+import asyncio
+import contextvars
+import logging
+import re
+import threading
+import time
+
+from langchain_core.runnables import RunnableLambda
+
+from tracing import metrics
+
+logger = logging.getLogger(__name__)
+
+# 未等待的后台任务需要保留引用, 否则可能被回收
+_background_tasks = set()
+
+
+class DecisionParser:
+    # 在流式输出的 JSON 中找出布尔字段, 所有字段都出现后即可做出路由决定, 不必等 reason 生成完
+    def __init__(self, keys):
+        self.patterns = {
+            key: re.compile(rf'"{key}"\s*:\s*"?(true|false)\b', re.IGNORECASE) for key in keys
+        }
+
+    @staticmethod
+    def answer_text(text):
+        # 推理模型 (deepseek-r1) 先输出 <think> 段, 其中可能出现字段名, 只解析之后的内容
+        if "<think>" in text:
+            _, sep, after = text.rpartition("</think>")
+            return after if sep else ""
+        return text
+
+    def parse(self, text):
+        text = self.answer_text(text)
+        decisions = {}
+        for key, pattern in self.patterns.items():
+            match = pattern.search(text)
+            if match is None:
+                return None
+            decisions[key] = match.group(1).lower() == "true"
+        return decisions
+
+
+def log_reason(call, text):
+    match = re.search(r'"reason"\s*:\s*"((?:[^"\\]|\\.)*)', text)
+    logger.debug("%s reason: %s", call, match.group(1) if match else text.strip())
+
+
+def early_exit_chain(chain, output_parser, keys, call, reason_mode="cancel"):
+    # chain 为 prompt | llm; 返回与 chain | output_parser 相同的结果, reason 为空
+    # reason_mode: cancel 关闭流 (连接断开后服务端停止生成) / background 在后台读完, 只用于日志
+    decision_parser = DecisionParser(keys)
+    result_type = output_parser.pydantic_object
+
+    def finish(start, decisions, text):
+        if decisions is None:
+            # 流结束仍没有找到字段, 按完整输出解析 (失败时由 RouterAgent 走回退)
+            metrics.inc("chatbot_router_early_exits_total", help="Router calls by early-exit outcome", call=call, outcome="complete")
+            return output_parser.parse(text)
+        metrics.inc("chatbot_router_early_exits_total", help="Router calls by early-exit outcome", call=call, outcome="early")
+        metrics.observe("chatbot_router_decision_seconds", time.perf_counter() - start, help="Time until the routing decision was parsed", call=call)
+        return result_type(reason="", **decisions)
+
+    def drain(stream, text):
+        try:
+            for chunk in stream:
+                text += chunk.content
+            log_reason(call, text)
+        except Exception as e:
+            logger.debug("%s background reason failed: %r", call, e)
+
+    def reap(task):
+        # 读取已结束任务的异常, 避免 "Task exception was never retrieved"
+        _background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug("%s background reason failed: %r", call, task.exception())
+
+    def run(inputs, config=None):
+        start = time.perf_counter()
+        stream = chain.stream(inputs, config=config)
+        text = ""
+        decisions = None
+        for chunk in stream:
+            text += chunk.content
+            decisions = decision_parser.parse(text)
+            if decisions is not None:
+                break
+        if decisions is not None:
+            if reason_mode == "background":
+                context = contextvars.copy_context()
+                threading.Thread(target=context.run, args=(drain, stream, text), daemon=True).start()
+            else:
+                stream.close()
+        return finish(start, decisions, text)
+
+    async def arun(inputs, config=None):
+        # 在单独的任务里读取流; 取消任务时异常沿调用栈传到 HTTP 请求, 连接会立即关闭
+        start = time.perf_counter()
+        decided = asyncio.get_running_loop().create_future()
+        text = ""
+
+        async def consume():
+            nonlocal text
+            async for chunk in chain.astream(inputs, config=config):
+                text += chunk.content
+                if not decided.done():
+                    decisions = decision_parser.parse(text)
+                    if decisions is not None:
+                        decided.set_result(decisions)
+            if decided.done():
+                log_reason(call, text)
+            else:
+                decided.set_result(None)
+
+        task = asyncio.create_task(consume())
+        try:
+            await asyncio.wait([task, decided], return_when=asyncio.FIRST_COMPLETED)
+        except BaseException:
+            task.cancel()
+            raise
+        if not decided.done():
+            # 流在做出决定之前出错
+            return task.result()
+        if task.done():
+            reap(task)
+        elif reason_mode == "background":
+            _background_tasks.add(task)
+            task.add_done_callback(reap)
+        else:
+            task.cancel()
+        return finish(start, decided.result(), text)
+
+    return RunnableLambda(run, afunc=arun, name=f"{call}_early_exit")
@@ -0,0 +1,132 @@
+import argparse
+import json
+import threading
+from pathlib import Path
+
+import numpy as np
+
+# 标签取值: 1 = 需要, 0 = 不需要, -1 = 该样例未标注此项
+LABEL_FIELDS = ("requires_retrieval", "requires_thinking")
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def load_exemplar_file(path):
+    # 每行一个 JSON: {"question": "...", "requires_retrieval": true, "requires_thinking": false}
+    questions = []
+    labels = {field: [] for field in LABEL_FIELDS}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            questions.append(item["question"])
+            for field in LABEL_FIELDS:
+                value = item.get(field)
+                labels[field].append(-1 if value is None else int(bool(value)))
+    return questions, {field: np.asarray(v, dtype=np.int8) for field, v in labels.items()}
+
+
+def build_exemplars(src_path, embedding_function, out_path):
+    questions, labels = load_exemplar_file(src_path)
+    vectors = _normalize(embedding_function.embed_documents(questions))
+    np.savez(
+        out_path,
+        vectors=vectors,
+        questions=np.asarray(questions),
+        **labels,
+    )
+    return len(questions)
+
+
+class FastRouter:
+    def __init__(self, embedding_function, exemplar_path, margin=0.05):
+        self.embedding_function = embedding_function
+        self.margin = margin
+
+        exemplar_path = Path(exemplar_path)
+        if exemplar_path.suffix == ".npz":
+            data = np.load(exemplar_path)
+            self.vectors = data["vectors"].astype(np.float32)
+            self.labels = {field: data[field] for field in LABEL_FIELDS}
+        else:
+            questions, self.labels = load_exemplar_file(exemplar_path)
+            self.vectors = _normalize(embedding_function.embed_documents(questions))
+
+        self._lock = threading.Lock()
+        self.counts = {"total": 0, "fast_path": 0, "partial": 0}
+
+    def _decide(self, similarities, field):
+        labels = self.labels[field]
+        positive = similarities[labels == 1]
+        negative = similarities[labels == 0]
+        if positive.size == 0 or negative.size == 0:
+            return None, 0.0
+        best_positive = float(positive.max())
+        best_negative = float(negative.max())
+        margin = best_positive - best_negative
+        if abs(margin) < self.margin:
+            return None, margin
+        return margin > 0, margin
+
+    def classify_vector(self, query_vector):
+        similarities = self.vectors @ _normalize(query_vector)
+        decisions = {}
+        for field in LABEL_FIELDS:
+            decisions[field] = self._decide(similarities, field)
+
+        decided = sum(value is not None for value, _ in decisions.values())
+        with self._lock:
+            self.counts["total"] += 1
+            if decided == len(LABEL_FIELDS):
+                self.counts["fast_path"] += 1
+            elif decided:
+                self.counts["partial"] += 1
+        return decisions
+
+    def classify(self, question):
+        # 返回 {字段: (判断结果或 None, 相似度差值)}, None 表示差值太小需要交给 LLM
+        return self.classify_vector(self.embedding_function.embed_query(question))
+
+    async def aclassify(self, question):
+        return self.classify_vector(await self.embedding_function.aembed_query(question))
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        total = counts["total"] or 1
+        counts["fast_path_rate"] = counts["fast_path"] / total
+        counts["partial_rate"] = counts["partial"] / total
+        return counts
+
+
+if __name__ == "__main__":
+    from agents.retriever import RetrieverAgent
+
+    parser = argparse.ArgumentParser(description="Build or evaluate router exemplars")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build")
+    build_parser.add_argument("src", help="exemplar JSONL file")
+    build_parser.add_argument("out", help="output .npz file")
+    eval_parser = subparsers.add_parser("eval")
+    eval_parser.add_argument("exemplars", help="exemplar .jsonl or .npz file")
+    eval_parser.add_argument("questions", help="text file with one question per line")
+    eval_parser.add_argument("--margin", type=float, default=0.05)
+    args = parser.parse_args()
+
+    embedding_function = RetrieverAgent().embedding_function
+    if args.command == "build":
+        count = build_exemplars(args.src, embedding_function, args.out)
+        print(f"已写入 {count} 条样例到 {args.out}")
+    else:
+        fast_router = FastRouter(embedding_function, args.exemplars, margin=args.margin)
+        with open(args.questions, encoding="utf-8") as f:
+            for question in filter(None, (line.strip() for line in f)):
+                print(question, fast_router.classify(question))
+        print(fast_router.stats())
@@ -1,9 +1,12 @@
 from langchain.prompts import ChatPromptTemplate
-from langchain_ollama import ChatOllama
-from langchain_openai import ChatOpenAI  # 添加 OpenAI 支持
 
 import os
 from dotenv import load_dotenv
+
+from clients import get_chat_model
+from context_packing import pack_context, token_budget
+from memory import format_conversation
+
 load_dotenv()
 
 
@@ -12,13 +15,15 @@ class ResponderAgent:
         # System 1 模型配置
         model_type_1 = os.getenv("RESPONDER_MODEL_TYPE_1", "ollama").lower()
         if model_type_1 == "ollama":
-            self.system1_model = ChatOllama(
+            self.system1_model = get_chat_model(
+                "ollama",
                 model=os.getenv("OLLAMA_RESPONDER_LLM_1", "llama3.1"),
                 base_url=os.getenv("OLLAMA_RESPONDER_LLM_1_BASE_URL", "http://localhost:11434"),
                 temperature=0
             )
         elif model_type_1 == "openai":
-            self.system1_model = ChatOpenAI(
+            self.system1_model = get_chat_model(
+                "openai",
                 model=os.getenv("OPENAI_RESPONDER_LLM_1", "gpt-3.5-turbo"),
                 api_key=os.getenv("OPENAI_RESPONDER_API_KEY_1"),
                 base_url=os.getenv("OPENAI_RESPONDER_BASE_URL_1", None),
@@ -30,13 +35,15 @@ class ResponderAgent:
         # System 2 模型配置
         model_type_2 = os.getenv("RESPONDER_MODEL_TYPE_2", "ollama").lower()
         if model_type_2 == "ollama":
-            self.system2_model = ChatOllama(
+            self.system2_model = get_chat_model(
+                "ollama",
                 model=os.getenv("OLLAMA_RESPONDER_LLM_2", "deepseek-r1:8b"),
                 base_url=os.getenv("OLLAMA_RESPONDER_LLM_2_BASE_URL", "http://localhost:11434"),
                 temperature=0
             )
         elif model_type_2 == "openai":
-            self.system2_model = ChatOpenAI(
+            self.system2_model = get_chat_model(
+                "openai",
                 model=os.getenv("OPENAI_RESPONDER_LLM_2", "gpt-4"),
                 api_key=os.getenv("OPENAI_RESPONDER_API_KEY_2"),
                 base_url=os.getenv("OPENAI_RESPONDER_BASE_URL_2", None),
@@ -50,7 +57,7 @@ class ResponderAgent:
 You are an intelligent responder agent. Given a user question, reply in a fun witty manner. 
 Reply in whatever language the question is in.
 
-Question: {question}
+{conversation}Question: {question}
 """
 
         self.responder_wRAG_prompt_template = """
@@ -61,10 +68,10 @@ Do not make up your own answer
 Reply in whatever language the question is in a fun witty manner.
 
 Retrieved Context: {retrieved_info}
-Question: {question}
+{conversation}Question: {question}
 """
 
-    def run(self, question, context="", req_think=False):
+    def build_chain(self, context="", req_think=False):
         if context == "":
             responder_prompt = ChatPromptTemplate.from_template(
                 self.responder_prompt_template
@@ -75,26 +82,56 @@ Question: {question}
             )
         if not req_think:
             llm = self.system1_model
+            llm_call = "responder_system_1"
         else:
             llm = self.system2_model
+            llm_call = "responder_system_2"
+
+        return (responder_prompt | llm).with_config(metadata={"llm_call": llm_call})
 
-        responder_chain = responder_prompt | llm
+    @staticmethod
+    def build_inputs(question, context="", conversation=""):
         if context == "":
-            result = responder_chain.invoke({"question": question})
-        else:
-            result = responder_chain.invoke(
-                {"question": question, "retrieved_info": context}
-            )
+            return {"question": question, "conversation": conversation}
+        return {"question": question, "retrieved_info": context, "conversation": conversation}
+
+    def run(self, question, context="", req_think=False, conversation=""):
+        responder_chain = self.build_chain(context, req_think)
+        result = responder_chain.invoke(self.build_inputs(question, context, conversation))
+        return result.content
+
+    async def arun(self, question, context="", req_think=False, conversation=""):
+        responder_chain = self.build_chain(context, req_think)
+        result = await responder_chain.ainvoke(self.build_inputs(question, context, conversation))
         return result.content
 
+    @staticmethod
+    def get_context(state):
+        # 有检索片段时按所用模型 (system 1 / system 2) 的 token 预算重新装填上下文
+        if state.get("retrieved_passages"):
+            return pack_context(
+                state["retrieved_passages"], token_budget(state.get("router_need_system_2"))
+            )
+        if state.get("retrieved_info"):
+            return state.get("retrieved_info")
+        return ""
+
     def invoke(self, state):
         question = state.get("question")
-        if state.get("retrieved_info"):
-            context = state.get("retrieved_info")
-        else:
-            context = ""
+        context = self.get_context(state)
+        conversation = format_conversation(state.get("history"), state.get("summary"))
         responder_reply = self.run(
-            question, context, state.get("router_need_system_2")
+            question, context, state.get("router_need_system_2"), conversation
+        )
+        state["responder_reply"] = responder_reply
+        return state
+
+    async def ainvoke(self, state):
+        question = state.get("question")
+        context = self.get_context(state)
+        conversation = format_conversation(state.get("history"), state.get("summary"))
+        responder_reply = await self.arun(
+            question, context, state.get("router_need_system_2"), conversation
         )
         state["responder_reply"] = responder_reply
         return state
@@ -1,16 +1,48 @@
 from langchain.prompts import ChatPromptTemplate
 from langchain.retrievers import ParentDocumentRetriever
-from langchain.storage import LocalFileStore
-from langchain.storage._lc_store import create_kv_docstore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_ollama import ChatOllama, OllamaEmbeddings
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings  # 添加 OpenAI 支持
+from langchain_core.documents import Document
 
+import asyncio
+import contextvars
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+
+from clients import get_chat_model
+from docstore import create_docstore
+from bm25 import BM25Index
+from context_packing import build_windows, pack_context, token_budget
+from embeddings import create_embedding_function
+from kb_version import current_kb_version
+from lru_cache import LRUCache, document_size
+from memory import format_conversation
+from mmr import maximal_marginal_relevance
+from tracing import SCORE_BUCKETS, metrics, span
+from vectorstores import FlatVectorStore, create_vectorstore
+
 load_dotenv()
 
+SEARCH_STRATEGIES = ("raw", "rewrite", "parallel")
+
+
+def reciprocal_rank_fusion(result_lists, key, weights=None, k=60, with_scores=False):
+    # RRF: score = sum(weight / (k + rank)), 只依赖排名, 不需要各路结果的分数可比
+    weights = weights or [1.0] * len(result_lists)
+    scores = {}
+    items = {}
+    for results, weight in zip(result_lists, weights):
+        for rank, item in enumerate(results):
+            item_key = key(item)
+            scores[item_key] = scores.get(item_key, 0.0) + weight / (k + rank + 1)
+            items.setdefault(item_key, item)
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    if with_scores:
+        return [(items[item_key], scores[item_key]) for item_key in ranked]
+    return [items[item_key] for item_key in ranked]
+
 
 class RetrieverAgent:
     def __init__(self):
@@ -19,26 +51,28 @@ class RetrieverAgent:
 
         # 初始化 LLM
         if model_type == "ollama":
-            self.llm = ChatOllama(
+            self.llm = get_chat_model(
+                "ollama",
                 model=os.getenv("OLLAMA_RETRIEVER_LLM", "llama3.1"),
                 base_url=os.getenv("OLLAMA_RETRIEVER_LLM_BASE_URL", "http://localhost:11434"),
                 temperature=0
             )
-            embedding_function = OllamaEmbeddings(
-                model=os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text:latest"),
-                base_url=os.getenv("OLLAMA_RETRIEVER_LLM_BASE_URL", "http://localhost:11434")
+            self.embedding_function = create_embedding_function(
+                model_type,
+                ollama_base_url=os.getenv("OLLAMA_RETRIEVER_LLM_BASE_URL", "http://localhost:11434"),
             )
         elif model_type == "openai":
-            self.llm = ChatOpenAI(
+            self.llm = get_chat_model(
+                "openai",
                 model=os.getenv("OPENAI_RETRIEVER_LLM", "gpt-4"),
                 api_key=os.getenv("OPENAI_RETRIEVER_API_KEY"),
                 base_url=os.getenv("OPENAI_RETRIEVER_BASE_URL", None),  # 可选 vLLM 端点
                 temperature=0
             )
-            embedding_function = OpenAIEmbeddings(
-                model=os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002"),
-                api_key=os.getenv("OPENAI_RETRIEVER_API_KEY"),
-                base_url=os.getenv("OPENAI_RETRIEVER_BASE_URL", None)
+            self.embedding_function = create_embedding_function(
+                model_type,
+                openai_api_key=os.getenv("OPENAI_RETRIEVER_API_KEY"),
+                openai_base_url=os.getenv("OPENAI_RETRIEVER_BASE_URL", None),
             )
         else:
             raise ValueError(f"Unsupported model type: {model_type}. Use 'ollama' or 'openai'.")
@@ -46,14 +80,29 @@ class RetrieverAgent:
         self.search_term_prompt_template = """
 # Task
 You are an intelligent search term suggestion agent. Given a user question, suggest search english terms, up to 3 words, which will optimize the vector search.
+If the question refers to earlier parts of the conversation, resolve the reference in the search terms.
 Strictly Return your response with just the search term.
 
-Question: {question}
+{conversation}Question: {question}
 """
         self.search_term_prompt = ChatPromptTemplate.from_template(
             self.search_term_prompt_template
         )
-        self.search_term_chain = self.search_term_prompt | self.llm
+        self.search_term_chain = (self.search_term_prompt | self.llm).with_config(
+            metadata={"llm_call": "search_term_rewrite"}
+        )
+
+        # 检索词策略: raw 直接用问题 / rewrite 先由 LLM 生成检索词 / parallel 两路同时检索后用 RRF 融合
+        self.search_strategy = os.getenv("RETRIEVER_SEARCH_STRATEGY", "rewrite").lower()
+        if self.search_strategy not in SEARCH_STRATEGIES:
+            raise ValueError(f"Unsupported search strategy: {self.search_strategy}. Use 'raw', 'rewrite' or 'parallel'.")
+        self.top_k = 3
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVER_MAX_WORKERS", "4")))
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            strategy: {"count": 0, "top_score": 0.0, "docs": 0, "latency": 0.0, "rewrite_latency": 0.0, "rewrite_only_docs": 0, "overlap": 0.0}
+            for strategy in SEARCH_STRATEGIES
+        }
         self.parent_splitter = RecursiveCharacterTextSplitter(
             chunk_size=3_000,
             chunk_overlap=50,
@@ -64,43 +113,385 @@ Question: {question}
             chunk_overlap=25,
         )
 
-        self.fs = LocalFileStore(f"knowledge_base/local_file_store")
-        self.store = create_kv_docstore(self.fs)
+        self.store = create_docstore()
 
-        self.vectorstore = Chroma(
-            collection_name="parent_docs",
-            embedding_function=embedding_function,
-            persist_directory=f"knowledge_base/vectorstore",
-        )
+        # VECTORSTORE_BACKEND: chroma 或 flat (内存映射的 NumPy 矩阵, 多进程共享页缓存)
+        self.vectorstore = create_vectorstore(self.embedding_function)
 
         self.retriever = ParentDocumentRetriever(
             vectorstore=self.vectorstore,
             docstore=self.store,
             child_splitter=self.child_splitter,
             parent_splitter=self.parent_splitter,
-            search_kwargs={"k": 3},
+            search_kwargs={"k": self.top_k},
+        )
+
+        # 进程内缓存: 父文档按 docstore ID 缓存, 检索结果按最终检索文本缓存, 知识库重建后自动清空
+        self.parent_cache = LRUCache(
+            max_entries=int(os.getenv("RETRIEVER_PARENT_CACHE_SIZE", "1024")),
+            max_bytes=int(os.getenv("RETRIEVER_PARENT_CACHE_MB", "64")) * 1024 * 1024,
+            sizeof=document_size,
+            name="retriever_parent",
+        )
+        self.result_cache = LRUCache(
+            max_entries=int(os.getenv("RETRIEVER_RESULT_CACHE_SIZE", "512")),
+            max_bytes=int(os.getenv("RETRIEVER_RESULT_CACHE_MB", "32")) * 1024 * 1024,
+            sizeof=lambda results: sum(document_size(r["parent"]) + 64 * len(r["hits"]) for r in results) + 64,
+            name="retriever_result",
+        )
+        self.kb_version = current_kb_version()
+
+        # 混合检索: BM25 词法检索与向量检索按权重做 RRF 融合, LEXICAL_WEIGHT=0 时只用向量检索
+        self.lexical_index_path = os.getenv("LEXICAL_INDEX_PATH", "knowledge_base/bm25.pkl")
+        self.dense_weight = float(os.getenv("HYBRID_DENSE_WEIGHT", "1.0"))
+        self.lexical_weight = float(os.getenv("HYBRID_LEXICAL_WEIGHT", "1.0"))
+        self.lexical_index = self.load_lexical_index()
+
+        # MMR 多样性重排: 先取 fetch_k 个候选子文档及其向量, 再选出 top_k 个互不重复的命中
+        self.mmr_enabled = os.getenv("RETRIEVER_MMR_ENABLED", "false").lower() == "true"
+        self.fetch_k = int(os.getenv("RETRIEVER_FETCH_K", "20"))
+        self.mmr_lambda = float(os.getenv("RETRIEVER_MMR_LAMBDA", "0.5"))
+
+    def check_kb_version(self):
+        # 版本号在内存中缓存, 每次检索最多只 stat 一次版本文件 (KB_VERSION_CHECK_INTERVAL 内不访问磁盘)
+        kb_version = current_kb_version()
+        if kb_version != self.kb_version:
+            self.kb_version = kb_version
+            self.parent_cache.clear()
+            self.result_cache.clear()
+            self.lexical_index = self.load_lexical_index()
+
+    def load_lexical_index(self):
+        if self.lexical_weight <= 0 or not os.path.exists(self.lexical_index_path):
+            return None
+        lexical_index = BM25Index.load(self.lexical_index_path)
+        # 加载时就构建查询用的数组, 第一个请求不用等待
+        lexical_index.compile()
+        return lexical_index
+
+    def fetch_candidates(self, query_vector):
+        if isinstance(self.vectorstore, FlatVectorStore):
+            return self.vectorstore.similarity_search_with_vectors(query_vector, self.fetch_k)
+        # 通过 Chroma 的公开接口取候选, 再按 id 取回已存储的子文档向量, 不需要重新嵌入
+        docs = self.vectorstore.similarity_search_by_vector(query_vector, k=self.fetch_k)
+        if not docs:
+            return [], []
+        stored = self.vectorstore.get(ids=[doc.id for doc in docs], include=["embeddings"])
+        vector_of = dict(zip(stored["ids"], stored["embeddings"]))
+        return docs, [vector_of[doc.id] for doc in docs]
+
+    def mmr_hits(self, query_vector, docs, vectors):
+        if not docs:
+            return []
+        selected, similarity = maximal_marginal_relevance(
+            query_vector, vectors, k=self.top_k, lambda_mult=self.mmr_lambda
         )
+        return [(docs[i], float(similarity[i])) for i in selected]
+
+    def dense_hits(self, search_text):
+        if not self.mmr_enabled:
+            return self.vectorstore.similarity_search_with_relevance_scores(search_text, k=self.top_k)
+        query_vector = self.embedding_function.embed_query(search_text)
+        return self.mmr_hits(query_vector, *self.fetch_candidates(query_vector))
+
+    async def adense_hits(self, search_text):
+        if not self.mmr_enabled:
+            return await self.vectorstore.asimilarity_search_with_relevance_scores(search_text, k=self.top_k)
+        query_vector = await self.embedding_function.aembed_query(search_text)
+        docs, vectors = await asyncio.to_thread(self.fetch_candidates, query_vector)
+        return self.mmr_hits(query_vector, docs, vectors)
+
+    def hybrid_hits(self, dense_hits, search_text):
+        lexical_index = self.lexical_index
+        if lexical_index is None:
+            return dense_hits
+        id_key = self.retriever.id_key
+        with span("retriever.lexical_search"):
+            lexical_hits = [
+                (Document(page_content=text, metadata={id_key: parent_id}), score)
+                for _, parent_id, text, score in lexical_index.search(search_text, self.top_k)
+            ]
+        fused = reciprocal_rank_fusion(
+            [dense_hits, lexical_hits],
+            key=lambda hit: (hit[0].metadata.get(id_key), hit[0].page_content),
+            weights=[self.dense_weight, self.lexical_weight],
+            with_scores=True,
+        )
+        # 融合后以 RRF 分数作为子文档的相关度
+        return [(hit[0], score) for hit, score in fused[:self.top_k]]
+
+    def group_hits(self, hits):
+        # 按父文档 ID 归并子文档命中, 保持命中顺序: {parent_id: [(子文档文本, 相关度)]}
+        grouped = {}
+        for d, score in hits:
+            parent_id = d.metadata.get(self.retriever.id_key)
+            if parent_id is not None:
+                grouped.setdefault(parent_id, []).append((d.page_content, score))
+        return grouped
+
+    def dense_scores(self, hits):
+        # 融合前每个父文档最相关子文档的向量相似度; RRF 分数只由排名决定, 不能用来比较检索质量
+        scores = {}
+        for d, score in hits:
+            parent_id = d.metadata.get(self.retriever.id_key)
+            if parent_id is not None:
+                scores[parent_id] = max(score, scores.get(parent_id, score))
+        return scores
+
+    @staticmethod
+    def build_results(grouped, parents, dense_scores):
+        # dense_score: 只由 BM25 命中的父文档为 0
+        return [
+            {"id": parent_id, "parent": parents[parent_id], "hits": hits, "dense_score": dense_scores.get(parent_id, 0.0)}
+            for parent_id, hits in grouped.items()
+            if parent_id in parents
+        ]
 
-    def run_search_term(self, question):
-        result = self.search_term_chain.invoke({"question": question})
-        search_terms = result.content
+    def split_cached(self, ids):
+        docs = {}
+        missing = []
+        for parent_id in ids:
+            doc = self.parent_cache.get(parent_id)
+            if doc is None:
+                missing.append(parent_id)
+            else:
+                docs[parent_id] = doc
+        return docs, missing
+
+    def fill_cache(self, docs, missing, fetched):
+        for parent_id, doc in zip(missing, fetched):
+            if doc is not None:
+                docs[parent_id] = doc
+                self.parent_cache.put(parent_id, doc)
+
+    def get_parents(self, ids):
+        docs, missing = self.split_cached(ids)
+        if missing:
+            with span("retriever.docstore_fetch", count=len(missing)):
+                self.fill_cache(docs, missing, self.store.mget(missing))
+        return docs
+
+    async def aget_parents(self, ids):
+        docs, missing = self.split_cached(ids)
+        if missing:
+            with span("retriever.docstore_fetch", count=len(missing)):
+                self.fill_cache(docs, missing, await self.store.amget(missing))
+        return docs
+
+    def retrieve(self, search_text):
+        # 返回 [{"id", "parent", "hits", "dense_score"}], 按最相关的子文档命中排序
+        self.check_kb_version()
+        results = self.result_cache.get(search_text)
+        if results is not None:
+            return list(results)
+        with span("retriever.vector_search"):
+            hits = self.dense_hits(search_text)
+        grouped = self.group_hits(self.hybrid_hits(hits, search_text))
+        results = self.build_results(grouped, self.get_parents(list(grouped)), self.dense_scores(hits))
+        self.result_cache.put(search_text, results)
+        return list(results)
+
+    async def aretrieve(self, search_text):
+        self.check_kb_version()
+        results = self.result_cache.get(search_text)
+        if results is not None:
+            return list(results)
+        with span("retriever.vector_search"):
+            hits = await self.adense_hits(search_text)
+        grouped = self.group_hits(self.hybrid_hits(hits, search_text))
+        results = self.build_results(grouped, await self.aget_parents(list(grouped)), self.dense_scores(hits))
+        self.result_cache.put(search_text, results)
+        return list(results)
+
+    def cache_stats(self):
+        return {
+            "parent_cache": self.parent_cache.stats(),
+            "result_cache": self.result_cache.stats(),
+        }
+
+    def run_search_term(self, question, cancel=None, conversation=""):
+        inputs = {"question": question, "conversation": conversation}
+        if cancel is None:
+            result = self.search_term_chain.invoke(inputs)
+            search_terms = result.content
+        else:
+            # 推测执行时流式生成, 一旦取消就停止读取, 连接随之关闭
+            search_terms = ""
+            for chunk in self.search_term_chain.stream(inputs):
+                if cancel.is_set():
+                    return None
+                search_terms += chunk.content
         search_text = f"{search_terms}, {question}"
         return search_text
 
-    def invoke(self, state):
-        question = state.get("question")
-        search_text = self.run_search_term(question)
-        relevant_docs = self.retriever.invoke(search_text)
-        retrieved_info = ""
-        for d in relevant_docs:
-            retrieved_info += d.page_content
-            retrieved_info += "\n"
+    async def arun_search_term(self, question, cancel=None, conversation=""):
+        inputs = {"question": question, "conversation": conversation}
+        if cancel is None:
+            result = await self.search_term_chain.ainvoke(inputs)
+            search_terms = result.content
+        else:
+            search_terms = ""
+            async for chunk in self.search_term_chain.astream(inputs):
+                if cancel.is_set():
+                    return None
+                search_terms += chunk.content
+        search_text = f"{search_terms}, {question}"
+        return search_text
+
+    def fuse(self, raw_results, rewrite_results):
+        fused = reciprocal_rank_fusion(
+            [raw_results, rewrite_results], key=lambda r: r["id"]
+        )[:self.top_k]
+        # 同一父文档在两路结果中的子文档命中合并, 相同子文档保留较高的相关度
+        merged_hits = {}
+        dense_scores = {}
+        for r in raw_results + rewrite_results:
+            hits = merged_hits.setdefault(r["id"], {})
+            for child_text, score in r["hits"]:
+                hits[child_text] = max(score, hits.get(child_text, score))
+            dense_scores[r["id"]] = max(r["dense_score"], dense_scores.get(r["id"], r["dense_score"]))
+        relevant_results = [
+            {**r, "hits": sorted(merged_hits[r["id"]].items(), key=lambda h: h[1], reverse=True), "dense_score": dense_scores[r["id"]]}
+            for r in fused
+        ]
+        raw_ids = {r["id"] for r in raw_results}
+        rewrite_ids = {r["id"] for r in rewrite_results}
+        rewrite_only_docs = sum(r["id"] not in raw_ids for r in relevant_results)
+        # 两路结果父文档的重合度 (Jaccard), 接近 1 说明改写几乎没有带来新的文档
+        union = raw_ids | rewrite_ids
+        overlap = len(raw_ids & rewrite_ids) / len(union) if union else 1.0
+        return relevant_results, rewrite_only_docs, overlap
+
+    def record_search(self, start, relevant_results, rewrite_latency, rewrite_only_docs, overlap):
+        strategy = self.search_strategy
+        latency = time.perf_counter() - start
+        # 本次检索结果中最高的向量相似度 (融合前), 不受混合检索的 RRF 分数影响; 没有结果记为 0
+        top_score = max((r["dense_score"] for r in relevant_results), default=0.0)
+        with self._stats_lock:
+            stats = self._stats[strategy]
+            stats["count"] += 1
+            stats["top_score"] += top_score
+            stats["docs"] += len(relevant_results)
+            stats["latency"] += latency
+            stats["rewrite_latency"] += rewrite_latency
+            stats["rewrite_only_docs"] += rewrite_only_docs
+            stats["overlap"] += overlap
+        metrics.inc("chatbot_retriever_searches_total", help="Knowledge base searches by strategy", strategy=strategy)
+        metrics.inc("chatbot_retriever_docs_total", len(relevant_results), help="Parent documents returned by searches", strategy=strategy)
+        metrics.observe("chatbot_retriever_search_seconds", latency, help="Search latency including the search-term rewrite", strategy=strategy)
+        metrics.observe("chatbot_retriever_top_score", top_score, SCORE_BUCKETS, help="Highest dense similarity among the returned documents", strategy=strategy)
+        if strategy == "parallel":
+            metrics.inc("chatbot_retriever_rewrite_only_docs_total", rewrite_only_docs, help="Returned documents found only by the rewritten query")
+            metrics.observe("chatbot_retriever_overlap", overlap, SCORE_BUCKETS, help="Jaccard overlap of raw and rewritten search results")
+
+    def search(self, question, cancel=None, conversation=""):
+        # 返回 (search_text, docs), 推测执行被取消时返回 None
+        start = time.perf_counter()
+        rewrite_latency = 0.0
+        rewrite_only_docs = 0
+        overlap = 0.0
+        if self.search_strategy == "raw":
+            search_text = question
+            relevant_results = self.retrieve(search_text)
+        elif self.search_strategy == "rewrite":
+            search_text = self.run_search_term(question, cancel, conversation)
+            rewrite_latency = time.perf_counter() - start
+            if search_text is None or (cancel is not None and cancel.is_set()):
+                return None
+            relevant_results = self.retrieve(search_text)
+        else:
+            # 生成检索词的同时先用原始问题检索
+            # 复制上下文, 让线程池中的检索也记录到当前请求的 trace
+            raw_future = self.executor.submit(contextvars.copy_context().run, self.retrieve, question)
+            search_text = self.run_search_term(question, cancel, conversation)
+            rewrite_latency = time.perf_counter() - start
+            if search_text is None or (cancel is not None and cancel.is_set()):
+                raw_future.cancel()
+                return None
+            rewrite_results = self.retrieve(search_text)
+            relevant_results, rewrite_only_docs, overlap = self.fuse(raw_future.result(), rewrite_results)
+
+        self.record_search(start, relevant_results, rewrite_latency, rewrite_only_docs, overlap)
+        return search_text, relevant_results
+
+    async def asearch(self, question, cancel=None, conversation=""):
+        start = time.perf_counter()
+        rewrite_latency = 0.0
+        rewrite_only_docs = 0
+        overlap = 0.0
+        if self.search_strategy == "raw":
+            search_text = question
+            relevant_results = await self.aretrieve(search_text)
+        elif self.search_strategy == "rewrite":
+            search_text = await self.arun_search_term(question, cancel, conversation)
+            rewrite_latency = time.perf_counter() - start
+            if search_text is None or (cancel is not None and cancel.is_set()):
+                return None
+            relevant_results = await self.aretrieve(search_text)
+        else:
+            raw_task = asyncio.create_task(self.aretrieve(question))
+            try:
+                search_text = await self.arun_search_term(question, cancel, conversation)
+            except BaseException:
+                raw_task.cancel()
+                raise
+            rewrite_latency = time.perf_counter() - start
+            if search_text is None or (cancel is not None and cancel.is_set()):
+                raw_task.cancel()
+                return None
+            rewrite_results = await self.aretrieve(search_text)
+            relevant_results, rewrite_only_docs, overlap = self.fuse(await raw_task, rewrite_results)
+
+        self.record_search(start, relevant_results, rewrite_latency, rewrite_only_docs, overlap)
+        return search_text, relevant_results
+
+    def search_stats(self):
+        report = {}
+        with self._stats_lock:
+            for strategy, stats in self._stats.items():
+                count = stats["count"]
+                if not count:
+                    continue
+                report[strategy] = {
+                    "count": count,
+                    "avg_top_score": stats["top_score"] / count,
+                    "avg_docs": stats["docs"] / count,
+                    "avg_latency": stats["latency"] / count,
+                    "avg_rewrite_latency": stats["rewrite_latency"] / count,
+                    # parallel 模式下只由改写检索贡献的文档数与两路结果的重合度, 衡量改写这次 LLM 调用是否值得 (其它模式为 0)
+                    "avg_rewrite_only_docs": stats["rewrite_only_docs"] / count,
+                    "avg_overlap": stats["overlap"] / count,
+                }
+        return report
+
+    def apply_search(self, state, result):
+        if result is None:
+            state["search_terms"] = ""
+            state["retrieved_passages"] = []
+            state["retrieved_info"] = ""
+            return state
+        search_text, relevant_results = result
+        # 只保留子文档命中附近的窗口, 去重后按相关度排序; responder 会按所用模型的 token 预算重新装填
+        passages = build_windows(relevant_results)
         state["search_terms"] = search_text
-        state["retrieved_info"] = retrieved_info
+        state["retrieved_passages"] = passages
+        state["retrieved_info"] = pack_context(passages, token_budget())
 
         return state
 
+    def invoke(self, state):
+        conversation = format_conversation(state.get("history"), state.get("summary"))
+        result = self.search(state.get("question"), state.get("cancel_retrieval"), conversation)
+        return self.apply_search(state, result)
+
+    async def ainvoke(self, state):
+        conversation = format_conversation(state.get("history"), state.get("summary"))
+        result = await self.asearch(state.get("question"), state.get("cancel_retrieval"), conversation)
+        return self.apply_search(state, result)
+
 if __name__ == "__main__":
     question = "who founded kredivo?"
     retriever_agent = RetrieverAgent()
-    retriever_agent.invoke({"question": question})
\ No newline at end of file
+    retriever_agent.invoke({"question": question})
+    print(retriever_agent.search_stats())
+    print(retriever_agent.cache_stats())
\ No newline at end of file
@@ -1,35 +1,76 @@
 # router.py
 from langchain.output_parsers import PydanticOutputParser
 from langchain.prompts import ChatPromptTemplate
-from langchain_ollama import ChatOllama
-from langchain_openai import ChatOpenAI  # 引入 OpenAI 兼容类
+from langchain_core.exceptions import OutputParserException
+from langchain_core.runnables import RunnableParallel
 from pydantic import BaseModel
+import logging
 import os
 from dotenv import load_dotenv
 
+from agents.early_exit import early_exit_chain
+from agents.fast_router import FastRouter
+from clients import get_chat_model
+from memory import format_conversation
+from tracing import metrics, span
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# reason 可以省略 (ROUTER_REASON=false), 省略后输出只剩布尔字段
 class RequireRetrieval(BaseModel):
     requires_retrieval: bool
-    reason: str
+    reason: str = ""
 
 class RequireThinking(BaseModel):
     requires_thinking: bool
-    reason: str
+    reason: str = ""
+
+class RequireRouting(BaseModel):
+    requires_retrieval: bool
+    requires_thinking: bool
+    reason: str = ""
+
+class RouterOutputParser(PydanticOutputParser):
+    # 记录每个路由调用的解析失败次数, 失败后仍然抛出, 由 RouterAgent 回退
+    llm_call: str = "router"
+
+    def parse_result(self, result, *, partial=False):
+        try:
+            return super().parse_result(result, partial=partial)
+        except OutputParserException:
+            metrics.inc("chatbot_router_parse_failures_total", help="Router outputs that did not match the schema", call=self.llm_call)
+            raise
+
+def route_schema(keys, include_reason=True):
+    # 布尔字段排在 reason 之前: 受约束的生成按 schema 的字段顺序输出, 提前退出时不必等 reason
+    properties = {key: {"type": "boolean"} for key in keys}
+    if include_reason:
+        properties["reason"] = {"type": "string"}
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
 
 class RouterAgent:
-    def __init__(self):
+    def __init__(self, embedding_function=None):
         # 从环境变量读取模型类型
         model_type = os.getenv("ROUTER_MODEL_TYPE", "ollama").lower()
+        self.model_type = model_type
 
         if model_type == "ollama":
-            self.llm = ChatOllama(
+            self.llm = get_chat_model(
+                "ollama",
                 model=os.getenv("OLLAMA_ROUTER_LLM", "llama3.1"),
                 base_url=os.getenv("OLLAMA_ROUTER_LLM_BASE_URL", "http://localhost:11434"),
                 temperature=0
             )
         elif model_type == "openai":
-            self.llm = ChatOpenAI(
+            self.llm = get_chat_model(
+                "openai",
                 model=os.getenv("OPENAI_ROUTER_LLM", "gpt-3.5-turbo"),
                 api_key=os.getenv("OPENAI_ROUTER_API_KEY"),
                 base_url=os.getenv("OPENAI_ROUTER_BASE_URL", None),  # vLLM 的 API 端点
@@ -38,9 +79,30 @@ class RouterAgent:
         else:
             raise ValueError(f"Unsupported model type: {model_type}. Use 'ollama' or 'openai'.")
 
-        # 以下保持不变
-        self.req_ret_output_parser = PydanticOutputParser(pydantic_object=RequireRetrieval)
-        self.req_thi_output_parser = PydanticOutputParser(pydantic_object=RequireThinking)
+        # 路由模式: serial 串行两次调用 / concurrent 两条链并发 / combined 一次调用同时给出两个判断
+        self.mode = os.getenv("ROUTER_MODE", "serial").lower()
+        if self.mode not in ("serial", "concurrent", "combined"):
+            raise ValueError(f"Unsupported router mode: {self.mode}. Use 'serial', 'concurrent' or 'combined'.")
+
+        # 基于向量相似度的快速路由, 相似度差值足够大时跳过 LLM
+        self.fast_router = None
+        if os.getenv("ROUTER_FAST_PATH", "false").lower() == "true" and embedding_function is not None:
+            self.fast_router = FastRouter(
+                embedding_function,
+                os.getenv("ROUTER_EXEMPLARS_PATH", "knowledge_base/router_exemplars.jsonl"),
+                margin=float(os.getenv("ROUTER_FAST_PATH_MARGIN", "0.05")),
+            )
+
+        # 结构化输出: off 只靠 prompt 约束 / json 后端保证输出合法 JSON / schema 后端按 JSON schema 约束生成 (Ollama format, OpenAI / vLLM response_format)
+        self.structured_output = os.getenv("ROUTER_STRUCTURED_OUTPUT", "off").lower()
+        if self.structured_output not in ("off", "json", "schema"):
+            raise ValueError(f"Unsupported router structured output: {self.structured_output}. Use 'off', 'json' or 'schema'.")
+        # 不需要 reason 时不生成, 输出更短
+        self.include_reason = os.getenv("ROUTER_REASON", "true").lower() == "true"
+
+        self.req_ret_output_parser = RouterOutputParser(pydantic_object=RequireRetrieval, llm_call="router_retrieval")
+        self.req_thi_output_parser = RouterOutputParser(pydantic_object=RequireThinking, llm_call="router_thinking")
+        self.req_route_output_parser = RouterOutputParser(pydantic_object=RequireRouting, llm_call="router_combined")
 
         self.req_ret_prompt_template = """
 # Task
@@ -50,7 +112,7 @@ You are an intelligent routing agent. Given a user question determine if the que
 Strictly Return your response in this JSON format:
 {{"requires_retrieval": "<bool>", "reason": "<explanation>"}}
 
-Question: {question}
+{conversation}Question: {question}
         """
 
         self.req_thi_prompt_template = """
@@ -61,33 +123,220 @@ You are an intelligent routing agent. Given a user question determine if the que
 Strictly Return your response in this JSON format:
 {{"requires_thinking": "<bool>", "reason": "<explanation>"}}
 
-Question: {question}
+{conversation}Question: {question}
         """
 
+        self.req_route_prompt_template = """
+# Task
+You are an intelligent routing agent. Given a user question determine if the question requires:
+- "knowledge retrieval on Kredivo". If the question is asking about Kredivo, requires_retrieval is True
+- "thinking". If the question is complicated and need some thinking before you can reply, requires_thinking is True
+
+Strictly Return your response in this JSON format:
+{{"requires_retrieval": "<bool>", "requires_thinking": "<bool>", "reason": "<explanation>"}}
+
+{conversation}Question: {question}
+        """
+
+        # 流式提前退出: off 等完整输出后解析 / cancel 布尔字段生成后立即返回并取消 reason 的生成 / background reason 在后台生成完, 只写日志
+        self.early_exit = os.getenv("ROUTER_EARLY_EXIT", "off").lower()
+        if self.early_exit not in ("off", "cancel", "background"):
+            raise ValueError(f"Unsupported router early exit: {self.early_exit}. Use 'off', 'cancel' or 'background'.")
+
+        if not self.include_reason:
+            self.req_ret_prompt_template = self.without_reason(self.req_ret_prompt_template)
+            self.req_thi_prompt_template = self.without_reason(self.req_thi_prompt_template)
+            self.req_route_prompt_template = self.without_reason(self.req_route_prompt_template)
+
         self.req_ret_prompt = ChatPromptTemplate.from_template(self.req_ret_prompt_template)
-        self.req_ret_chain = self.req_ret_prompt | self.llm | self.req_ret_output_parser
+        self.req_ret_chain = self.build_chain(
+            self.req_ret_prompt, self.req_ret_output_parser, ["requires_retrieval"], "router_retrieval"
+        )
 
         self.req_thi_prompt = ChatPromptTemplate.from_template(self.req_thi_prompt_template)
-        self.req_thi_chain = self.req_thi_prompt | self.llm | self.req_thi_output_parser
+        self.req_thi_chain = self.build_chain(
+            self.req_thi_prompt, self.req_thi_output_parser, ["requires_thinking"], "router_thinking"
+        )
+
+        self.req_route_prompt = ChatPromptTemplate.from_template(self.req_route_prompt_template)
+        self.req_route_chain = self.build_chain(
+            self.req_route_prompt, self.req_route_output_parser, ["requires_retrieval", "requires_thinking"], "router_combined"
+        )
+
+        # 两条判断链并发执行 (同步调用时走线程池, 异步调用时走 asyncio.gather)
+        self.req_parallel_chain = RunnableParallel(
+            retrieval=self.req_ret_chain,
+            thinking=self.req_thi_chain,
+        )
+
+    @staticmethod
+    def without_reason(template):
+        return template.replace(', "reason": "<explanation>"', "")
+
+    def structured_llm(self, keys, llm_call):
+        if self.structured_output == "off":
+            return self.llm
+        if self.model_type == "ollama":
+            if self.structured_output == "json":
+                return self.llm.bind(format="json")
+            return self.llm.bind(format=route_schema(keys, self.include_reason))
+        if self.structured_output == "json":
+            return self.llm.bind(response_format={"type": "json_object"})
+        return self.llm.bind(response_format={
+            "type": "json_schema",
+            "json_schema": {"name": llm_call, "schema": route_schema(keys, self.include_reason), "strict": True},
+        })
+
+    def build_chain(self, prompt, output_parser, keys, llm_call):
+        chain = (prompt | self.structured_llm(keys, llm_call)).with_config(metadata={"llm_call": llm_call})
+        if self.early_exit == "off":
+            return chain | output_parser
+        return early_exit_chain(chain, output_parser, keys, llm_call, reason_mode=self.early_exit)
 
-    def run(self, question):
-        ret_result = self.req_ret_chain.invoke({"question": question})
-        thi_result = self.req_thi_chain.invoke({"question": question})
+    def run(self, question, conversation=""):
+        inputs = {"question": question, "conversation": conversation}
+        if self.mode == "combined":
+            route_result = self.req_route_chain.invoke(inputs)
+            return self.split_route_result(route_result)
+        if self.mode == "concurrent":
+            results = self.req_parallel_chain.invoke(inputs)
+            return results["retrieval"], results["thinking"]
+        ret_result = self.req_ret_chain.invoke(inputs)
+        thi_result = self.req_thi_chain.invoke(inputs)
         return ret_result, thi_result
 
+    async def arun(self, question, conversation=""):
+        inputs = {"question": question, "conversation": conversation}
+        if self.mode == "combined":
+            route_result = await self.req_route_chain.ainvoke(inputs)
+            return self.split_route_result(route_result)
+        if self.mode == "concurrent":
+            results = await self.req_parallel_chain.ainvoke(inputs)
+            return results["retrieval"], results["thinking"]
+        ret_result = await self.req_ret_chain.ainvoke(inputs)
+        thi_result = await self.req_thi_chain.ainvoke(inputs)
+        return ret_result, thi_result
+
+    @staticmethod
+    def fast_path_results(decisions):
+        need_retrieval, ret_margin = decisions["requires_retrieval"]
+        need_thinking, thi_margin = decisions["requires_thinking"]
+        ret_result = thi_result = None
+        if need_retrieval is not None:
+            ret_result = RequireRetrieval(
+                requires_retrieval=need_retrieval,
+                reason=f"fast path, similarity margin {ret_margin:.3f}",
+            )
+        if need_thinking is not None:
+            thi_result = RequireThinking(
+                requires_thinking=need_thinking,
+                reason=f"fast path, similarity margin {thi_margin:.3f}",
+            )
+        return ret_result, thi_result
+
+    def needs_full_run(self, ret_result, thi_result):
+        # 只把没有把握的判断交给 LLM, combined 模式下一次调用就能拿到两个判断
+        both_undecided = ret_result is None and thi_result is None
+        one_undecided = ret_result is None or thi_result is None
+        return both_undecided or (one_undecided and self.mode == "combined")
+
+    @staticmethod
+    def record_fast_path(outcome):
+        # fast 两个判断都由向量快速路由给出 / partial 只给出一个 / llm 都交给 LLM / follow_up 有对话历史, 跳过快速路由
+        metrics.inc("chatbot_router_fast_path_total", help="Router fast-path outcomes", outcome=outcome)
+
+    def fast_path_outcome(self, ret_result, thi_result):
+        decided = (ret_result is not None) + (thi_result is not None)
+        self.record_fast_path(("llm", "partial", "fast")[decided])
+
+    def route(self, question, conversation=""):
+        inputs = {"question": question, "conversation": conversation}
+        if self.fast_router is None:
+            return self.run(question, conversation)
+        # 追问依赖上文, 只看问题本身的向量快速路由可能误判, 有对话历史时直接交给 LLM
+        if conversation:
+            self.record_fast_path("follow_up")
+            return self.run(question, conversation)
+
+        with span("router.fast_path"):
+            decisions = self.fast_router.classify(question)
+        ret_result, thi_result = self.fast_path_results(decisions)
+        self.fast_path_outcome(ret_result, thi_result)
+        if self.needs_full_run(ret_result, thi_result):
+            llm_ret_result, llm_thi_result = self.run(question, conversation)
+            return ret_result or llm_ret_result, thi_result or llm_thi_result
+        if ret_result is None:
+            ret_result = self.req_ret_chain.invoke(inputs)
+        if thi_result is None:
+            thi_result = self.req_thi_chain.invoke(inputs)
+        return ret_result, thi_result
+
+    async def aroute(self, question, conversation=""):
+        inputs = {"question": question, "conversation": conversation}
+        if self.fast_router is None:
+            return await self.arun(question, conversation)
+        if conversation:
+            self.record_fast_path("follow_up")
+            return await self.arun(question, conversation)
+
+        with span("router.fast_path"):
+            decisions = await self.fast_router.aclassify(question)
+        ret_result, thi_result = self.fast_path_results(decisions)
+        self.fast_path_outcome(ret_result, thi_result)
+        if self.needs_full_run(ret_result, thi_result):
+            llm_ret_result, llm_thi_result = await self.arun(question, conversation)
+            return ret_result or llm_ret_result, thi_result or llm_thi_result
+        if ret_result is None:
+            ret_result = await self.req_ret_chain.ainvoke(inputs)
+        if thi_result is None:
+            thi_result = await self.req_thi_chain.ainvoke(inputs)
+        return ret_result, thi_result
+
+    @staticmethod
+    def split_route_result(route_result):
+        # 把合并后的判断拆回两个结果, 保持 run() 的返回格式不变
+        ret_result = RequireRetrieval(
+            requires_retrieval=route_result.requires_retrieval,
+            reason=route_result.reason,
+        )
+        thi_result = RequireThinking(
+            requires_thinking=route_result.requires_thinking,
+            reason=route_result.reason,
+        )
+        return ret_result, thi_result
+
+    def apply_route(self, state, ret_result, thi_result):
+        state["router_need_retriever"] = ret_result.requires_retrieval
+        state["router_need_system_2"] = thi_result.requires_thinking
+        state["router_need_retriever_reason"] = ret_result.reason
+        state["router_need_system_2_reason"] = thi_result.reason
+        return state
+
+    def apply_fallback(self, state, error):
+        logger.warning("router failed, falling back to system 1 without retrieval: %r", error)
+        cause = "parse" if isinstance(error, OutputParserException) else "error"
+        metrics.inc("chatbot_router_fallbacks_total", help="Router errors answered with the fallback route", cause=cause)
+        state["router_need_retriever"] = False
+        state["router_need_system_2"] = False
+        return state
+
     def invoke(self, state):
         question = state.get("question")
+        conversation = format_conversation(state.get("history"), state.get("summary"))
         try:
-            ret_result, thi_result = self.run(question)
-            state["router_need_retriever"] = ret_result.requires_retrieval
-            state["router_need_system_2"] = thi_result.requires_thinking
-            state["router_need_retriever_reason"] = ret_result.reason
-            state["router_need_system_2_reason"] = thi_result.reason
+            ret_result, thi_result = self.route(question, conversation)
         except Exception as e:
-            print(e)
-            state["router_need_retriever"] = False
-            state["router_need_system_2"] = False
-        return state
+            return self.apply_fallback(state, e)
+        return self.apply_route(state, ret_result, thi_result)
+
+    async def ainvoke(self, state):
+        question = state.get("question")
+        conversation = format_conversation(state.get("history"), state.get("summary"))
+        try:
+            ret_result, thi_result = await self.aroute(question, conversation)
+        except Exception as e:
+            return self.apply_fallback(state, e)
+        return self.apply_route(state, ret_result, thi_result)
 
 if __name__ == "__main__":
     question = 'how many "y" is in strawberry?'
@@ -1,23 +1,26 @@
+import logging
+import os
+
 import streamlit as st
-from graph import workflow
+from graph import conversation_memory, stream_reply
+from memory import empty_memory
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
 st.title("Starter Pack Chatbot")
 st.markdown("未冉之芊")
 
 def stream_data():
-    for msg, metadata in workflow.stream(
-        {
-            "question": prompt,
-        },
-        stream_mode="messages",
-    ):
-        if metadata["langgraph_node"] == "responder":
-            stream = msg.content
-            yield stream
+    # 当前问题之前的消息: 最近几轮原样传入, 更早的只传摘要
+    inputs = conversation_memory.inputs(st.session_state.messages[:-1], st.session_state.memory)
+    yield from stream_reply(prompt, inputs["history"], inputs["summary"])
 
 # 初始化会话状态
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "memory" not in st.session_state:
+    st.session_state.memory = empty_memory()
 
 # 显示历史消息
 for message in st.session_state.messages:
@@ -31,9 +34,15 @@ if prompt := st.chat_input("Type your message here..."):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        print(prompt)
+        logger.info("question received (%d chars)", len(prompt))
         response = st.write_stream(stream_data)
         st.session_state.messages.append({"role": "assistant", "content": response})
+
+    # 把滑出窗口的轮次并入摘要; 失败时保留旧摘要, 下一轮再试
+    try:
+        st.session_state.memory = conversation_memory.update(st.session_state.memory, st.session_state.messages)
+    except Exception as e:
+        logger.warning("conversation summary failed: %r", e)
     
     # 自动刷新页面
     st.rerun()
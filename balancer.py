@@ -0,0 +1,395 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any
+
+import httpx
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from pydantic import ConfigDict
+
+from tracing import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 所有负载均衡器, 用于导出各端点的统计
+balancers = []
+
+
+def split_endpoints(base_url):
+    # 环境变量中的地址可以是逗号分隔的多个端点
+    if not base_url or "," not in base_url:
+        return None
+    return [url.strip() for url in base_url.split(",") if url.strip()]
+
+
+def is_retryable(error):
+    # 4xx (除 429) 是请求本身的问题, 换一个端点也不会成功
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return not (status is not None and 400 <= status < 500 and status != 429)
+
+
+class Endpoint:
+    def __init__(self, url, client):
+        self.url = url
+        self.client = client
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.state = "closed"  # closed 正常 / open 熔断 / half_open 试探中
+        self.opened_at = 0.0
+        self.ewma_latency = None
+        self.latencies = deque(maxlen=256)
+
+    def stats(self):
+        latencies = np.asarray(self.latencies, dtype=np.float64) * 1000
+        return {
+            "url": self.url,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "ewma_ms": self.ewma_latency * 1000 if self.ewma_latency is not None else None,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p95_ms": float(np.percentile(latencies, 95)) if len(latencies) else None,
+        }
+
+
+class LoadBalancer:
+    # 按未完成请求数最少分发; 连续失败达到阈值后熔断, 冷却后放一个请求试探, 成功则恢复
+    def __init__(self, name, endpoints, health_url=None, failure_threshold=3, cooldown=30.0,
+                 health_check_interval=10.0, headers=None):
+        self.name = name
+        self.endpoints = endpoints
+        self.health_url = health_url
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health_check_interval = health_check_interval
+        self.headers = headers or {}
+        self._lock = threading.Lock()
+        self._thread = None
+        balancers.append(self)
+        if health_url is not None and health_check_interval > 0:
+            self._thread = threading.Thread(target=self.run_health_checks, name=f"health-{name}", daemon=True)
+            self._thread.start()
+
+    def available(self, endpoint, now):
+        if endpoint.state == "closed":
+            return True
+        if endpoint.state == "open" and now - endpoint.opened_at >= self.cooldown:
+            endpoint.state = "half_open"
+            return True
+        # 试探期间只放行一个请求
+        return endpoint.state == "half_open" and endpoint.outstanding == 0
+
+    def acquire(self, exclude=()):
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            healthy = [e for e in candidates if self.available(e, now)]
+            if not healthy:
+                # 全部熔断时仍然尝试最早熔断的端点, 而不是直接失败
+                healthy = sorted(candidates, key=lambda e: e.opened_at)[:1]
+            if not healthy:
+                return None
+            least = min(e.outstanding for e in healthy)
+            tied = [e for e in healthy if e.outstanding == least]
+            # 未完成请求数相同时优先延迟低的, 没有延迟数据的端点排在有数据的之后
+            endpoint = min(tied, key=lambda e: (e.ewma_latency if e.ewma_latency is not None else float("inf"), random.random()))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint, latency, error=None):
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.consecutive_failures = 0
+                endpoint.state = "closed"
+                endpoint.latencies.append(latency)
+                endpoint.ewma_latency = latency if endpoint.ewma_latency is None else 0.8 * endpoint.ewma_latency + 0.2 * latency
+            elif is_retryable(error):
+                endpoint.failures += 1
+                endpoint.consecutive_failures += 1
+                if endpoint.state == "half_open" or endpoint.consecutive_failures >= self.failure_threshold:
+                    self.open(endpoint)
+        status = "ok" if error is None else "error"
+        metrics.inc("chatbot_endpoint_requests_total", help="Requests per backend endpoint", balancer=self.name, endpoint=endpoint.url, status=status)
+        if error is None:
+            metrics.observe("chatbot_endpoint_seconds", latency, help="Backend endpoint latency (first token for streams)", balancer=self.name, endpoint=endpoint.url)
+
+    def abandon(self, endpoint):
+        # 调用方在第一个 token 之前放弃了请求: 只归还端点, 不算成功也不算失败; 试探被放弃时回到熔断, 允许下一个请求重新试探
+        with self._lock:
+            endpoint.outstanding -= 1
+            if endpoint.state == "half_open":
+                endpoint.state = "open"
+        metrics.inc("chatbot_endpoint_requests_total", help="Requests per backend endpoint", balancer=self.name, endpoint=endpoint.url, status="abandoned")
+
+    def open(self, endpoint):
+        if endpoint.state != "open":
+            logger.warning("%s: circuit opened for %s", self.name, endpoint.url)
+            metrics.inc("chatbot_endpoint_circuit_opens_total", help="Circuit breaker trips per endpoint", balancer=self.name, endpoint=endpoint.url)
+        endpoint.state = "open"
+        endpoint.opened_at = time.monotonic()
+
+    def check(self, endpoint):
+        try:
+            response = httpx.get(self.health_url(endpoint.url), headers=self.headers, timeout=5)
+            healthy = response.status_code < 500
+        except httpx.HTTPError:
+            healthy = False
+        with self._lock:
+            if not healthy:
+                self.open(endpoint)
+            elif endpoint.state == "open":
+                # 健康检查通过后直接恢复, 不必等冷却结束
+                endpoint.state = "closed"
+                endpoint.consecutive_failures = 0
+                logger.info("%s: %s recovered", self.name, endpoint.url)
+
+    def run_health_checks(self):
+        while True:
+            for endpoint in self.endpoints:
+                self.check(endpoint)
+            time.sleep(self.health_check_interval)
+
+    def stats(self):
+        with self._lock:
+            return {"name": self.name, "endpoints": [e.stats() for e in self.endpoints]}
+
+
+def balancer_stats():
+    return [b.stats() for b in balancers]
+
+
+def create_balancer(name, endpoints, health_url=None, headers=None):
+    return LoadBalancer(
+        name,
+        endpoints,
+        health_url=health_url,
+        failure_threshold=int(os.getenv("LB_FAILURE_THRESHOLD", "3")),
+        cooldown=float(os.getenv("LB_COOLDOWN", "30")),
+        health_check_interval=float(os.getenv("LB_HEALTH_CHECK_INTERVAL", "10")),
+        headers=headers,
+    )
+
+
+class BalancedChatModel(BaseChatModel):
+    # 把多个端点上的同一个模型包装成一个聊天模型; 在输出第一个 token 之前失败会自动换一个端点重试
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    model: str
+    balancer: Any
+
+    @property
+    def _llm_type(self):
+        return "balanced-chat"
+
+    @property
+    def backends(self):
+        return [e.client for e in self.balancer.endpoints]
+
+    def _attempts(self):
+        tried = []
+        while True:
+            endpoint = self.balancer.acquire(exclude=tried)
+            if endpoint is None:
+                return
+            tried.append(endpoint)
+            yield endpoint
+
+    def _failover(self, endpoint, error, produced):
+        # 返回 True 表示继续尝试下一个端点
+        if produced or not is_retryable(error):
+            return False
+        logger.warning("%s: %s failed, failing over: %r", self.balancer.name, endpoint.url, error)
+        metrics.inc("chatbot_endpoint_failovers_total", help="Requests retried on another endpoint", balancer=self.balancer.name)
+        return True
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        error = None
+        for endpoint in self._attempts():
+            start = time.perf_counter()
+            released = False
+            try:
+                result = endpoint.client._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start)
+                return result
+            except Exception as e:
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start, e)
+                error = e
+                if self._failover(endpoint, e, produced=False):
+                    continue
+                raise
+            finally:
+                # 请求被取消 (客户端断开) 时也要归还端点, 不改变熔断状态
+                if not released:
+                    self.balancer.abandon(endpoint)
+        raise error
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        error = None
+        for endpoint in self._attempts():
+            start = time.perf_counter()
+            released = False
+            try:
+                result = await endpoint.client._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start)
+                return result
+            except Exception as e:
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start, e)
+                error = e
+                if self._failover(endpoint, e, produced=False):
+                    continue
+                raise
+            finally:
+                # 请求被取消 (客户端断开) 时也要归还端点, 不改变熔断状态
+                if not released:
+                    self.balancer.abandon(endpoint)
+        raise error
+
+    def _release_stream(self, endpoint, start, first, completed):
+        if first is None and not completed:
+            self.balancer.abandon(endpoint)
+        else:
+            self.balancer.release(endpoint, first if first is not None else time.perf_counter() - start)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        error = None
+        for endpoint in self._attempts():
+            start = time.perf_counter()
+            first = None
+            released = False
+            completed = False
+            try:
+                for chunk in endpoint.client._stream(messages, stop=stop, **kwargs):
+                    if first is None:
+                        first = time.perf_counter() - start
+                    yield chunk
+                completed = True
+            except Exception as e:
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start, e)
+                error = e
+                if self._failover(endpoint, e, produced=first is not None):
+                    continue
+                raise
+            finally:
+                # 调用方提前停止读取 (例如推测检索被取消) 时也要归还端点; 还没有输出 token 时不改变熔断状态
+                if not released:
+                    self._release_stream(endpoint, start, first, completed)
+            return
+        raise error
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        error = None
+        for endpoint in self._attempts():
+            start = time.perf_counter()
+            first = None
+            released = False
+            completed = False
+            try:
+                async for chunk in endpoint.client._astream(messages, stop=stop, **kwargs):
+                    if first is None:
+                        first = time.perf_counter() - start
+                    yield chunk
+                completed = True
+            except Exception as e:
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start, e)
+                error = e
+                if self._failover(endpoint, e, produced=first is not None):
+                    continue
+                raise
+            finally:
+                if not released:
+                    self._release_stream(endpoint, start, first, completed)
+            return
+        raise error
+
+
+class BalancedEmbeddings(Embeddings):
+    # 嵌入请求没有流式输出, 任何可重试的失败都换一个端点
+    def __init__(self, balancer):
+        self.balancer = balancer
+
+    @property
+    def backends(self):
+        return [e.client for e in self.balancer.endpoints]
+
+    def _call(self, method, *args):
+        error = None
+        tried = []
+        while (endpoint := self.balancer.acquire(exclude=tried)) is not None:
+            tried.append(endpoint)
+            start = time.perf_counter()
+            released = False
+            try:
+                result = getattr(endpoint.client, method)(*args)
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start)
+                return result
+            except Exception as e:
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start, e)
+                error = e
+                if is_retryable(e):
+                    logger.warning("%s: %s failed, failing over: %r", self.balancer.name, endpoint.url, e)
+                    continue
+                raise
+            finally:
+                if not released:
+                    self.balancer.abandon(endpoint)
+        raise error
+
+    async def _acall(self, method, *args):
+        error = None
+        tried = []
+        while (endpoint := self.balancer.acquire(exclude=tried)) is not None:
+            tried.append(endpoint)
+            start = time.perf_counter()
+            released = False
+            try:
+                result = await getattr(endpoint.client, method)(*args)
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start)
+                return result
+            except Exception as e:
+                released = True
+                self.balancer.release(endpoint, time.perf_counter() - start, e)
+                error = e
+                if is_retryable(e):
+                    logger.warning("%s: %s failed, failing over: %r", self.balancer.name, endpoint.url, e)
+                    continue
+                raise
+            finally:
+                if not released:
+                    self.balancer.abandon(endpoint)
+        raise error
+
+    def embed_documents(self, texts):
+        return self._call("embed_documents", texts)
+
+    def embed_query(self, text):
+        return self._call("embed_query", text)
+
+    async def aembed_documents(self, texts):
+        return await self._acall("aembed_documents", texts)
+
+    async def aembed_query(self, text):
+        return await self._acall("aembed_query", text)
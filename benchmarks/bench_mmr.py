@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks import fakes
+from benchmarks.bench_pipeline import populate, summarize
+
+BACKENDS = ("chroma", "flat")
+
+
+def configure_environment(args):
+    # 先设好环境变量再导入 agents, 只保留向量检索; 嵌入延迟默认为 0, 只测检索与重排
+    os.environ.update({
+        "ANONYMIZED_TELEMETRY": "False",
+        "SEMANTIC_CACHE_ENABLED": "false",
+        "EMBEDDING_CACHE_ENABLED": "false",
+        "HYBRID_LEXICAL_WEIGHT": "0",
+        "TRACE_ENABLED": "false",
+    })
+    fakes.settings.update({"embed_latency": args.embed_latency, "dim": args.dim})
+
+
+def time_dense_hits(agent, queries, repeat):
+    samples = []
+    for _ in range(repeat):
+        for query in queries:
+            start = time.perf_counter()
+            agent.dense_hits(query)
+            samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def bench_backend(backend, args):
+    from agents.retriever import RetrieverAgent
+
+    root = Path(backend)
+    os.environ.update({
+        "VECTORSTORE_BACKEND": backend,
+        "VECTORSTORE_PATH": str(root / "vectorstore"),
+        "FLAT_INDEX_PATH": str(root / "flat_index"),
+        "DOCSTORE_FILE_PATH": str(root / "local_file_store"),
+        "DOCSTORE_SQLITE_PATH": str(root / "docstore.sqlite"),
+    })
+    agent = RetrieverAgent()
+    agent.top_k = args.k
+    populate(agent, args.corpus_size)
+    queries = [fakes.lorem(6, seed=10 ** 6 + i) for i in range(args.queries)]
+
+    agent.mmr_enabled = False
+    time_dense_hits(agent, queries[:5], 1)  # 预热
+    baseline = time_dense_hits(agent, queries, args.repeat)
+    results = [{"backend": backend, "mmr": False, "k": args.k, "fetch_k": None, **baseline}]
+    agent.mmr_enabled = True
+    for fetch_k in args.fetch_k:
+        agent.fetch_k = fetch_k
+        stats = time_dense_hits(agent, queries, args.repeat)
+        results.append({
+            "backend": backend,
+            "mmr": True,
+            "k": args.k,
+            "fetch_k": fetch_k,
+            **stats,
+            "extra_mean_ms": stats["mean_ms"] - baseline["mean_ms"],
+        })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="RetrieverAgent.dense_hits 开启与关闭 MMR 时每次查询的延迟")
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=list(BACKENDS))
+    parser.add_argument("--corpus-size", type=int, default=10_000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--fetch-k", type=int, nargs="+", default=[10, 20, 50, 100])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--embed-latency", type=float, default=0.0)
+    parser.add_argument("--workdir", help="向量库所在目录, 默认使用临时目录")
+    args = parser.parse_args(argv)
+
+    configure_environment(args)
+    fakes.patch_models()
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="chatbot-bench-mmr-")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+
+    results = []
+    for backend in args.backends:
+        print(f"running {backend} ...", file=sys.stderr)
+        results.extend(bench_backend(backend, args))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.bench_mmr --corpus-size 10000 --fetch-k 20 50
+    main()
@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import contextlib
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks import fakes
+
+PACKAGE_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = PACKAGE_DIR / "benchmarks" / "results"
+SECTIONS = ("ingestion", "retrieval", "router", "ttft")
+
+
+def summarize(samples):
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    if len(values) == 0:
+        return {"n": 0}
+    return {
+        "n": len(values),
+        "mean_ms": float(values.mean()),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=PACKAGE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@contextlib.contextmanager
+def latency(**overrides):
+    # 临时修改假模型的延迟参数
+    saved = {k: fakes.settings[k] for k in overrides}
+    fakes.settings.update(overrides)
+    try:
+        yield
+    finally:
+        fakes.settings.update(saved)
+
+
+def questions(n):
+    # 一半与 Kredivo 有关 (走检索), 一半闲聊
+    return [
+        f"what is the kredivo {fakes.lorem(3, seed=i)}?" if i % 2 == 0 else f"tell me a joke about {fakes.lorem(2, seed=i)}"
+        for i in range(n)
+    ]
+
+
+def make_pdfs(pdf_dir, count, pages, words_per_page):
+    import fitz
+
+    pdf_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        pdf = fitz.open()
+        for p in range(pages):
+            page = pdf.new_page()
+            page.insert_textbox(page.rect + (36, 36, -36, -36), fakes.lorem(words_per_page, seed=i * 1000 + p), fontsize=6)
+        pdf.save(str(pdf_dir / f"doc_{i:04d}.pdf"))
+        pdf.close()
+
+
+def bench_ingestion(args):
+    make_pdfs(Path("knowledge_base/pdf"), args.pdfs, args.pages, args.words_per_page)
+    import create_vs
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):
+        create_vs.main(["--rebuild"])
+    elapsed = time.perf_counter() - start
+
+    manifest = create_vs.load_manifest()
+    pages = args.pdfs * args.pages
+    chunks = sum(len(entry["child_ids"]) for entry in manifest.values())
+    return {
+        "pdfs": args.pdfs,
+        "pages": pages,
+        "parents": sum(len(entry["parent_ids"]) for entry in manifest.values()),
+        "chunks": chunks,
+        "seconds": elapsed,
+        "pages_per_s": pages / elapsed,
+        "chunks_per_s": chunks / elapsed,
+    }
+
+
+def populate(agent, size, children_per_parent=10, batch_size=1_000):
+    from langchain_core.documents import Document
+
+    id_key = agent.retriever.id_key
+    with latency(embed_latency=0, embed_latency_per_text=0):
+        for offset in range(0, size, batch_size):
+            texts = [fakes.lorem(40, seed=i) for i in range(offset, min(size, offset + batch_size))]
+            parent_ids = [f"p{i // children_per_parent}" for i in range(offset, offset + len(texts))]
+            agent.vectorstore.add_texts(
+                texts,
+                metadatas=[{id_key: parent_id} for parent_id in parent_ids],
+                ids=[f"c{i}" for i in range(offset, offset + len(texts))],
+            )
+            parents = {}
+            for parent_id, text in zip(parent_ids, texts):
+                parents.setdefault(parent_id, []).append(text)
+            agent.store.mset([(pid, Document(page_content="\n".join(t))) for pid, t in parents.items()])
+
+
+def bench_retrieval(args):
+    from agents.retriever import RetrieverAgent
+
+    results = []
+    for size in args.corpus_sizes:
+        # 每个语料规模使用独立的向量库与文档库
+        root = Path("retrieval") / str(size)
+        os.environ.update({
+            "VECTORSTORE_PATH": str(root / "vectorstore"),
+            "FLAT_INDEX_PATH": str(root / "flat_index"),
+            "DOCSTORE_FILE_PATH": str(root / "local_file_store"),
+            "DOCSTORE_SQLITE_PATH": str(root / "docstore.sqlite"),
+        })
+        agent = RetrieverAgent()
+        agent.mmr_enabled = args.mmr
+        start = time.perf_counter()
+        populate(agent, size)
+        populate_seconds = time.perf_counter() - start
+
+        for k in args.ks:
+            agent.top_k = k
+            agent.result_cache.clear()
+            samples = []
+            for i in range(args.queries):
+                query = fakes.lorem(6, seed=10 ** 6 + i)
+                start = time.perf_counter()
+                agent.retrieve(query)
+                samples.append(time.perf_counter() - start)
+            results.append({
+                "backend": os.environ["VECTORSTORE_BACKEND"],
+                "corpus_size": size,
+                "k": k,
+                "mmr": args.mmr,
+                "populate_seconds": populate_seconds,
+                **summarize(samples),
+            })
+    return results
+
+
+def bench_router(args):
+    from agents.router import RouterAgent
+
+    results = []
+    for mode in args.router_modes:
+        os.environ["ROUTER_MODE"] = mode
+        router_agent = RouterAgent()
+        entry = {"mode": mode}
+        # 零延迟的假模型下测得的时间就是 router 自身的开销 (prompt 组装、解析、线程调度)
+        with latency(first_token_latency=0, tokens_per_second=0):
+            entry["overhead"] = summarize(
+                [timed(router_agent.invoke, {"question": q}) for q in questions(args.queries)]
+            )
+        entry["latency"] = summarize(
+            [timed(router_agent.invoke, {"question": q}) for q in questions(args.queries)]
+        )
+        results.append(entry)
+    return results
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def measure_stream(stream):
+    start = time.perf_counter()
+    first = None
+    for chunk in stream:
+        if first is None and chunk:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+async def ameasure_stream(stream):
+    start = time.perf_counter()
+    first = None
+    async for chunk in stream:
+        if first is None and chunk:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+
+def bench_ttft(args):
+    from agents.responder import ResponderAgent
+
+    results = []
+    # 单独测 responder, 作为 workflow 首 token 时间的下限
+    responder_agent = ResponderAgent()
+    chain = responder_agent.build_chain()
+    samples = [
+        measure_stream(chunk.content for chunk in chain.stream(responder_agent.build_inputs(q)))
+        for q in questions(args.queries)
+    ]
+    results.append({
+        "target": "responder",
+        "ttft": summarize([s[0] for s in samples]),
+        "total": summarize([s[1] for s in samples]),
+    })
+
+    graph = None
+    for graph_mode in args.graph_modes:
+        os.environ["GRAPH_MODE"] = graph_mode
+        # graph 在导入时按 GRAPH_MODE 构建 workflow, 切换模式需要重新加载
+        graph = importlib.import_module("graph") if graph is None else importlib.reload(graph)
+        sync_samples = [measure_stream(graph.stream_reply(q)) for q in questions(args.queries)]
+
+        async def run_async():
+            return [await ameasure_stream(graph.astream_reply(q)) for q in questions(args.queries)]
+
+        async_samples = asyncio.run(run_async())
+        for api, samples in (("stream", sync_samples), ("astream", async_samples)):
+            results.append({
+                "target": "workflow",
+                "graph_mode": graph_mode,
+                "api": api,
+                "ttft": summarize([s[0] for s in samples if s[0] is not None]),
+                "total": summarize([s[1] for s in samples]),
+            })
+    return results
+
+
+def configure_environment(args):
+    # 先设好环境变量再导入任何仓库模块, 这些模块在导入时读取配置; load_dotenv 不会覆盖已有的值
+    os.environ.update({
+        "ANONYMIZED_TELEMETRY": "False",
+        "VECTORSTORE_BACKEND": args.backend,
+        "SEMANTIC_CACHE_ENABLED": "false",
+        "EMBEDDING_CACHE_ENABLED": "false",
+        "ROUTER_FAST_PATH": "false",
+        "HYBRID_LEXICAL_WEIGHT": "0",
+        "TRACE_ENABLED": "true" if args.trace else "false",
+    })
+    fakes.settings.update({
+        "first_token_latency": args.first_token_latency,
+        "tokens_per_second": args.tokens_per_second,
+        "reply_tokens": args.reply_tokens,
+        "embed_latency": args.embed_latency,
+        "dim": args.dim,
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="离线基准测试: 用假模型测量构建、检索、路由与首 token 时间")
+    parser.add_argument("--only", nargs="+", choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument("--output", help="结果 JSON 路径, 默认 benchmarks/results/pipeline-<commit>-<时间>.json")
+    parser.add_argument("--workdir", help="工作目录 (知识库等), 默认使用临时目录")
+    parser.add_argument("--backend", choices=("chroma", "flat"), default="chroma")
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=64)
+    parser.add_argument("--embed-latency", type=float, default=0.02)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--pdfs", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[1_000, 10_000])
+    parser.add_argument("--ks", type=int, nargs="+", default=[3, 10])
+    parser.add_argument("--mmr", action="store_true")
+    parser.add_argument("--router-modes", nargs="+", default=["serial", "concurrent", "combined"])
+    parser.add_argument("--graph-modes", nargs="+", default=["serial", "speculative"])
+    parser.add_argument("--queries", type=int, default=20)
+    parser.add_argument("--trace", action="store_true", help="同时写入请求 trace, 计入其开销")
+    args = parser.parse_args(argv)
+
+    output = Path(args.output).resolve() if args.output else None
+    configure_environment(args)
+    fakes.patch_models()
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="chatbot-bench-")).resolve()
+    workdir.mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "workdir": str(workdir),
+        "args": {k: v for k, v in vars(args).items() if k not in ("output", "workdir")},
+    }
+    benches = {"ingestion": bench_ingestion, "retrieval": bench_retrieval, "router": bench_router, "ttft": bench_ttft}
+    # ttft 使用 ingestion 构建的知识库, 按固定顺序执行
+    for section in SECTIONS:
+        if section in args.only:
+            print(f"running {section} ...", file=sys.stderr)
+            report[section] = benches[section](args)
+
+    if output is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        output = RESULTS_DIR / f"pipeline-{report['commit'] or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(json.dumps(report, indent=2))
+    print(f"saved to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.bench_pipeline --only retrieval --corpus-sizes 1000 10000 --ks 3 10
+    main()
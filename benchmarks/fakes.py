@@ -0,0 +1,163 @@
+import asyncio
+import random
+import time
+import zlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# 假模型的延迟参数, 基准测试运行中可以随时修改 (例如灌库时把嵌入延迟设为 0)
+settings = {
+    "first_token_latency": 0.2,  # 秒, 模拟 prefill
+    "tokens_per_second": 50.0,
+    "reply_tokens": 64,
+    "embed_latency": 0.02,  # 秒, 每次嵌入请求的固定开销
+    "embed_latency_per_text": 0.001,
+    "dim": 768,
+}
+
+WORDS = (
+    "kredivo credit loan payment limit interest merchant installment account user "
+    "fintech indonesia founder company service approval application risk model data "
+    "repayment customer bank partner fee month year digital lending platform team"
+).split()
+
+
+def lorem(n, seed=0):
+    rng = random.Random(seed)
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def fake_reply(prompt):
+    # 按 prompt 中的关键字模拟 router / 检索词 / responder 的输出
+    question = prompt.rsplit("Question:", 1)[-1].lower()
+    need_retrieval = "true" if "kredivo" in question else "false"
+    need_thinking = "true" if "plan" in question else "false"
+    if "requires_retrieval" in prompt and "requires_thinking" in prompt:
+        return (f'{{"requires_retrieval": {need_retrieval}, "requires_thinking": {need_thinking}, '
+                f'"reason": "benchmark"}}')
+    if "requires_retrieval" in prompt:
+        return f'{{"requires_retrieval": {need_retrieval}, "reason": "benchmark"}}'
+    if "requires_thinking" in prompt:
+        return f'{{"requires_thinking": {need_thinking}, "reason": "benchmark"}}'
+    if "search term" in prompt:
+        return "kredivo credit limit"
+    return lorem(settings["reply_tokens"], seed=zlib.crc32(question.encode("utf-8")))
+
+
+def split_tokens(text):
+    # 每个词 (带前导空格) 算一个 token
+    words = text.split(" ")
+    return [words[0]] + [" " + w for w in words[1:]]
+
+
+class FakeChatModel(BaseChatModel):
+    # 不访问网络的聊天模型: 首 token 前等待 first_token_latency, 之后按 tokens_per_second 逐个输出
+    model: str = "fake"
+
+    @property
+    def _llm_type(self):
+        return "fake-chat"
+
+    @staticmethod
+    def _prompt(messages):
+        return "\n".join(str(m.content) for m in messages)
+
+    @staticmethod
+    def _usage(prompt, tokens):
+        prompt_tokens = len(prompt.split())
+        return {"input_tokens": prompt_tokens, "output_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+
+    @staticmethod
+    def _token_delay():
+        tokens_per_second = settings["tokens_per_second"]
+        return 1 / tokens_per_second if tokens_per_second > 0 else 0
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = self._prompt(messages)
+        tokens = split_tokens(fake_reply(prompt))
+        time.sleep(settings["first_token_latency"] + self._token_delay() * (len(tokens) - 1))
+        message = AIMessage(content="".join(tokens), usage_metadata=self._usage(prompt, tokens))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = self._prompt(messages)
+        tokens = split_tokens(fake_reply(prompt))
+        await asyncio.sleep(settings["first_token_latency"] + self._token_delay() * (len(tokens) - 1))
+        message = AIMessage(content="".join(tokens), usage_metadata=self._usage(prompt, tokens))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = self._prompt(messages)
+        tokens = split_tokens(fake_reply(prompt))
+        for i, token in enumerate(tokens):
+            time.sleep(settings["first_token_latency"] if i == 0 else self._token_delay())
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(prompt, tokens)))
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = self._prompt(messages)
+        tokens = split_tokens(fake_reply(prompt))
+        for i, token in enumerate(tokens):
+            await asyncio.sleep(settings["first_token_latency"] if i == 0 else self._token_delay())
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(prompt, tokens)))
+
+
+class FakeEmbeddings(Embeddings):
+    # 确定性的词袋哈希向量: 共享词越多的文本越相似, 检索结果有意义且可复现
+    def __init__(self, dim=None):
+        self.dim = dim or settings["dim"]
+
+    def _vector(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            h = zlib.crc32(word.encode("utf-8"))
+            vector[h % self.dim] += 1.0 if h & 1 << 31 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _delay(self, n):
+        return settings["embed_latency"] + settings["embed_latency_per_text"] * n
+
+    def embed_documents(self, texts):
+        time.sleep(self._delay(len(texts)))
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self._delay(len(texts)))
+        return [self._vector(t) for t in texts]
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+def fake_chat_model(**kwargs):
+    return FakeChatModel(model=kwargs.get("model") or "fake")
+
+
+def fake_embeddings(**kwargs):
+    return FakeEmbeddings()
+
+
+def patch_models():
+    # 替换共享客户端注册表中的模型构造函数; 必须在创建任何 agent (以及导入 graph) 之前调用
+    import clients
+
+    clients.ChatOllama = fake_chat_model
+    clients.ChatOpenAI = fake_chat_model
+    clients.OllamaEmbeddings = fake_embeddings
+    clients.OpenAIEmbeddings = fake_embeddings
+    clients.clear()
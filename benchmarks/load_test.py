@@ -0,0 +1,253 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from benchmarks.bench_pipeline import PACKAGE_DIR, RESULTS_DIR, git_commit, populate, questions, summarize
+
+
+def load_questions(path, n):
+    # 每行一个问题, 或 JSONL 中的 {"question": ...}; 未指定时使用生成的问题
+    if path is None:
+        return questions(n)
+    items = []
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        line = line.strip()
+        if line:
+            items.append(json.loads(line)["question"] if line.startswith("{") else line)
+    return items
+
+
+def start_mock_server(args):
+    command = [
+        sys.executable, "-m", "benchmarks.mock_ollama",
+        "--port", str(args.mock_port),
+        "--parallel", str(args.mock_parallel),
+        "--first-token-latency", str(args.first_token_latency),
+        "--tokens-per-second", str(args.tokens_per_second),
+        "--reply-tokens", str(args.reply_tokens),
+        "--embed-latency", str(args.embed_latency),
+    ]
+    process = subprocess.Popen(command, cwd=PACKAGE_DIR)
+    url = f"http://127.0.0.1:{args.mock_port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"{url}/api/tags", timeout=1).raise_for_status()
+            return process, url
+        except httpx.HTTPError:
+            if process.poll() is not None:
+                raise SystemExit("mock ollama 启动失败")
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("mock ollama 启动超时")
+
+
+def configure_environment(url, trace_path):
+    # 所有模型都指向同一个 Ollama (或 mock) 地址; 关闭会掩盖负载的缓存
+    os.environ.update({
+        "ANONYMIZED_TELEMETRY": "False",
+        "ROUTER_MODEL_TYPE": "ollama",
+        "RETRIEVER_MODEL_TYPE": "ollama",
+        "RESPONDER_MODEL_TYPE_1": "ollama",
+        "RESPONDER_MODEL_TYPE_2": "ollama",
+        "EMBEDDING_MODEL_TYPE": "ollama",
+        "OLLAMA_ROUTER_LLM_BASE_URL": url,
+        "OLLAMA_RETRIEVER_LLM_BASE_URL": url,
+        "OLLAMA_RESPONDER_LLM_1_BASE_URL": url,
+        "OLLAMA_RESPONDER_LLM_2_BASE_URL": url,
+        "OLLAMA_BASE_URL": url,
+        "SEMANTIC_CACHE_ENABLED": "false",
+        "EMBEDDING_CACHE_ENABLED": "false",
+        "ROUTER_FAST_PATH": "false",
+        "TRACE_ENABLED": "true",
+        "TRACE_LOG_PATH": str(trace_path),
+    })
+
+
+def node_breakdown(records):
+    # 每个节点: 执行耗时、调度等待 (上游节点结束到本节点开始) 以及其中 LLM 请求在服务端的排队时间
+    stats = {}
+    for record in records:
+        nodes = [s for s in record["spans"] if s["name"].startswith("node.")]
+        llm_spans = [s for s in record["spans"] if s["kind"] == "llm"]
+        for node in nodes:
+            upstream_ends = [
+                other["offset"] + other["duration"]
+                for other in nodes
+                if other is not node and other["offset"] + other["duration"] <= node["offset"]
+            ]
+            end = node["offset"] + node["duration"]
+            queue = sum(
+                s.get("load_seconds", 0.0) for s in llm_spans if node["offset"] <= s["offset"] <= end
+            )
+            entry = stats.setdefault(node["name"][len("node."):], {"duration": [], "scheduling": [], "llm_queue": []})
+            entry["duration"].append(node["duration"])
+            entry["scheduling"].append(node["offset"] - max(upstream_ends, default=0.0))
+            entry["llm_queue"].append(queue)
+    return {name: {k: summarize(v) for k, v in entry.items()} for name, entry in stats.items()}
+
+
+async def run_level(graph, corpus, concurrency, requests, arrival_rate, timeout, seed):
+    # arrival_rate > 0: 按泊松过程到达 (开环), 请求等待空闲的虚拟用户; 否则每个虚拟用户结束一个请求后立即发下一个 (闭环)
+    rng = random.Random(seed)
+    users = asyncio.Semaphore(concurrency)
+    results = []
+
+    async def consume(question, result):
+        async for chunk in graph.astream_reply(question):
+            if result["ttft"] is None and chunk:
+                result["ttft"] = time.perf_counter() - result["start"]
+
+    async def one(question, scheduled):
+        async with users:
+            result = {"client_wait": time.perf_counter() - scheduled, "start": time.perf_counter(), "ttft": None, "error": None}
+            try:
+                await asyncio.wait_for(consume(question, result), timeout)
+            except asyncio.TimeoutError:
+                result["error"] = "timeout"
+            except Exception as e:
+                result["error"] = repr(e)
+            result["latency"] = time.perf_counter() - result["start"]
+            results.append(result)
+
+    start = time.perf_counter()
+    tasks = []
+    for i in range(requests):
+        question = corpus[i % len(corpus)]
+        if arrival_rate > 0:
+            await asyncio.sleep(rng.expovariate(arrival_rate))
+        tasks.append(asyncio.create_task(one(question, time.perf_counter())))
+    await asyncio.gather(*tasks)
+    return results, time.perf_counter() - start
+
+
+def level_report(concurrency, results, records, wall):
+    ok = [r for r in results if r["error"] is None]
+    errors = {}
+    for r in results:
+        if r["error"] is not None:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "throughput_rps": len(ok) / wall if wall else 0.0,
+        "error_rate": 1 - len(ok) / len(results) if results else 0.0,
+        "errors": errors,
+        "latency": summarize([r["latency"] for r in ok]),
+        "ttft": summarize([r["ttft"] for r in ok if r["ttft"] is not None]),
+        "client_wait": summarize([r["client_wait"] for r in results]),
+        "nodes": node_breakdown(records),
+    }
+
+
+def find_saturation(levels, factor, max_error_rate):
+    # 第一个 p95 延迟超过最低并发时 factor 倍, 或错误率超过阈值的并发级别
+    baseline = levels[0]["latency"].get("p95_ms") if levels else None
+    for previous, level in zip([None] + levels, levels):
+        p95 = level["latency"].get("p95_ms")
+        if level["error_rate"] > max_error_rate or p95 is None or (baseline and p95 > factor * baseline):
+            return {
+                "saturated_at": level["concurrency"],
+                "max_sustainable_concurrency": previous["concurrency"] if previous else None,
+            }
+    return {"saturated_at": None, "max_sustainable_concurrency": levels[-1]["concurrency"] if levels else None}
+
+
+def print_level(level):
+    latency, ttft = level["latency"], level["ttft"]
+    print(
+        f"users={level['concurrency']:>4} rps={level['throughput_rps']:6.2f} "
+        f"p50={latency.get('p50_ms', 0):8.0f}ms p95={latency.get('p95_ms', 0):8.0f}ms p99={latency.get('p99_ms', 0):8.0f}ms "
+        f"ttft_p50={ttft.get('p50_ms', 0):7.0f}ms ttft_p99={ttft.get('p99_ms', 0):7.0f}ms errors={level['error_rate']:.1%}",
+        file=sys.stderr,
+    )
+
+
+async def run_levels(graph, corpus, args, records):
+    levels = []
+    for i, concurrency in enumerate(args.concurrency):
+        records.clear()
+        requests = args.requests or concurrency * args.requests_per_user
+        results, wall = await run_level(graph, corpus, concurrency, requests, args.arrival_rate, args.timeout, args.seed + i)
+        level = level_report(concurrency, results, list(records), wall)
+        print_level(level)
+        levels.append(level)
+    return levels
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="并发压测: 以多个虚拟用户重放问题集, 报告延迟分位数、首 token 时间与饱和点")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--requests", type=int, default=0, help="每个并发级别的请求总数, 默认 并发数 * requests-per-user")
+    parser.add_argument("--requests-per-user", type=int, default=5)
+    parser.add_argument("--arrival-rate", type=float, default=0.0, help="每秒到达的请求数, 0 表示闭环")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--questions", help="问题集文件 (每行一个问题或 JSONL)")
+    parser.add_argument("--ollama-url", help="已有的 Ollama 或 mock 地址; 不指定时启动本地 mock")
+    parser.add_argument("--mock-port", type=int, default=11500)
+    parser.add_argument("--mock-parallel", type=int, default=4, help="mock 同时处理的生成请求数 (OLLAMA_NUM_PARALLEL)")
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=64)
+    parser.add_argument("--embed-latency", type=float, default=0.02)
+    parser.add_argument("--corpus-size", type=int, default=1_000, help="写入临时知识库的子文档数")
+    parser.add_argument("--saturation-factor", type=float, default=2.0)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    args = parser.parse_args(argv)
+
+    output = Path(args.output).resolve() if args.output else None
+    corpus = load_questions(args.questions, 50)
+    process = None
+    url = args.ollama_url
+    if url is None:
+        process, url = start_mock_server(args)
+    try:
+        workdir = Path(tempfile.mkdtemp(prefix="chatbot-load-"))
+        configure_environment(url, workdir / "traces.jsonl")
+        os.chdir(workdir)
+
+        import graph
+        import tracing
+
+        populate(graph.retriever_agent, args.corpus_size)
+        records = []
+        tracing.listeners.append(records.append)
+        levels = asyncio.run(run_levels(graph, corpus, args, records))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "target": url if args.ollama_url else "mock",
+        "graph_mode": os.getenv("GRAPH_MODE", "serial"),
+        "router_mode": os.getenv("ROUTER_MODE", "serial"),
+        "args": {k: v for k, v in vars(args).items() if k != "output"},
+        "levels": levels,
+        **find_saturation(levels, args.saturation_factor, args.max_error_rate),
+    }
+    if output is None:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        output = RESULTS_DIR / f"load-{report['commit'] or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"saturated_at={report['saturated_at']} max_sustainable_concurrency={report['max_sustainable_concurrency']}", file=sys.stderr)
+    print(f"saved to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.load_test --concurrency 1 4 16 --mock-parallel 4
+    main()
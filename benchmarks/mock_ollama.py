@@ -0,0 +1,212 @@
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from benchmarks import fakes
+from benchmarks.fakes import FakeEmbeddings, fake_reply, split_tokens
+from warmup import model_tag, parse_keep_alive
+
+# 模拟 Ollama HTTP 接口, 用于在没有 GPU 的机器上做容量规划
+# parallel 对应 OLLAMA_NUM_PARALLEL: 同时处理的生成请求数, 其余请求排队等待空闲槽位
+# 模型在 keep_alive 到期后卸载, 下一次请求先等待 load_latency 秒重新加载
+settings = {
+    "load_latency": 0.0,
+    "first_token_latency": 0.2,
+    "tokens_per_second": 50.0,
+    "embed_latency": 0.02,
+    "embed_latency_per_text": 0.0005,
+    "parallel": 4,
+    "dim": 768,
+}
+runtime = {"slots": None, "waiting": 0, "active": 0, "requests": 0, "cold_loads": 0, "loaded": {}, "loading": {}}
+
+app = FastAPI(title="mock ollama")
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def slots():
+    if runtime["slots"] is None:
+        runtime["slots"] = asyncio.Semaphore(settings["parallel"])
+    return runtime["slots"]
+
+
+async def ensure_loaded(model, keep_alive):
+    # 返回加载耗时; 同一模型的并发请求共用一次加载
+    model = model_tag(model)
+    keep_alive = parse_keep_alive("5m" if keep_alive is None else keep_alive)
+    lock = runtime["loading"].setdefault(model, asyncio.Lock())
+    async with lock:
+        start = time.perf_counter()
+        expires_at = runtime["loaded"].get(model)
+        if expires_at is None or expires_at <= time.time():
+            runtime["cold_loads"] += 1
+            await asyncio.sleep(settings["load_latency"])
+        runtime["loaded"][model] = time.time() + keep_alive if keep_alive >= 0 else float("inf")
+        return time.perf_counter() - start
+
+
+def final_fields(model, prompt, tokens, queued, started):
+    # load_duration 包括模型加载与排队等待槽位的时间, 二者都表现为额外的首 token 延迟
+    elapsed = time.perf_counter() - started
+    return {
+        "model": model,
+        "created_at": now(),
+        "done": True,
+        "done_reason": "stop",
+        "total_duration": int((elapsed + queued) * 1e9),
+        "load_duration": int(queued * 1e9),
+        "prompt_eval_count": len(prompt.split()),
+        "prompt_eval_duration": int(settings["first_token_latency"] * 1e9),
+        "eval_count": len(tokens),
+        "eval_duration": int(max(elapsed - settings["first_token_latency"], 0) * 1e9),
+    }
+
+
+def token_delay():
+    tokens_per_second = settings["tokens_per_second"]
+    return 1 / tokens_per_second if tokens_per_second > 0 else 0
+
+
+async def generate_tokens(prompt):
+    tokens = split_tokens(fake_reply(prompt))
+    for i, token in enumerate(tokens):
+        await asyncio.sleep(settings["first_token_latency"] if i == 0 else token_delay())
+        yield i, token, tokens
+
+
+async def handle_generation(body, prompt, wrap):
+    # wrap(token) 生成 /api/chat 或 /api/generate 各自的消息格式
+    model = body.get("model", "mock")
+    runtime["requests"] += 1
+    arrived = time.perf_counter()
+    await ensure_loaded(model, body.get("keep_alive"))
+
+    async def run():
+        runtime["waiting"] += 1
+        async with slots():
+            runtime["waiting"] -= 1
+            runtime["active"] += 1
+            started = time.perf_counter()
+            queued = started - arrived
+            try:
+                async for i, token, tokens in generate_tokens(prompt):
+                    yield i, token, tokens, queued, started
+            finally:
+                runtime["active"] -= 1
+
+    if body.get("stream", True):
+        async def lines():
+            tokens, queued, started = [], 0.0, time.perf_counter()
+            async for _, token, tokens, queued, started in run():
+                yield json.dumps({"model": model, "created_at": now(), **wrap(token), "done": False}) + "\n"
+            yield json.dumps({**wrap(""), **final_fields(model, prompt, tokens, queued, started)}) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    content, tokens, queued, started = "", [], 0.0, time.perf_counter()
+    async for _, token, tokens, queued, started in run():
+        content += token
+    return JSONResponse({**wrap(content), **final_fields(model, prompt, tokens, queued, started)})
+
+
+@app.post("/api/chat")
+async def chat(request: Request):
+    body = await request.json()
+    prompt = "\n".join(str(m.get("content", "")) for m in body.get("messages", []))
+    return await handle_generation(body, prompt, lambda token: {"message": {"role": "assistant", "content": token}})
+
+
+@app.post("/api/generate")
+async def generate(request: Request):
+    body = await request.json()
+    if not body.get("prompt"):
+        # 空 prompt 只用于加载模型 / 设置 keep_alive
+        load = await ensure_loaded(body.get("model", "mock"), body.get("keep_alive"))
+        return JSONResponse({
+            "model": body.get("model"), "created_at": now(), "response": "", "done": True, "load_duration": int(load * 1e9),
+        })
+    return await handle_generation(body, body["prompt"], lambda token: {"response": token})
+
+
+@app.post("/api/embed")
+async def embed(request: Request):
+    body = await request.json()
+    texts = body.get("input", [])
+    texts = [texts] if isinstance(texts, str) else texts
+    load = await ensure_loaded(body.get("model", "mock"), body.get("keep_alive"))
+    await asyncio.sleep(settings["embed_latency"] + settings["embed_latency_per_text"] * len(texts))
+    embeddings = FakeEmbeddings(settings["dim"])
+    return {
+        "model": body.get("model"), "embeddings": [embeddings._vector(t) for t in texts], "load_duration": int(load * 1e9),
+    }
+
+
+@app.post("/api/embeddings")
+async def legacy_embeddings(request: Request):
+    body = await request.json()
+    await asyncio.sleep(settings["embed_latency"])
+    return {"embedding": FakeEmbeddings(settings["dim"])._vector(body.get("prompt", ""))}
+
+
+def expires_at_iso(expires_at):
+    if expires_at == float("inf"):
+        return "2318-08-21T00:00:00+00:00"
+    return datetime.fromtimestamp(expires_at, timezone.utc).isoformat()
+
+
+@app.get("/api/tags")
+async def tags():
+    return {"models": [{"name": model, "model": model} for model in runtime["loaded"]]}
+
+
+@app.get("/api/ps")
+async def ps():
+    current = time.time()
+    return {"models": [
+        {"name": model, "model": model, "expires_at": expires_at_iso(expires_at)}
+        for model, expires_at in runtime["loaded"].items()
+        if expires_at > current
+    ]}
+
+
+@app.get("/stats")
+async def stats():
+    return {k: runtime[k] for k in ("waiting", "active", "requests", "cold_loads")}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模拟 Ollama 服务 (聊天、生成与嵌入接口)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--load-latency", type=float, default=settings["load_latency"], help="模型冷启动加载时间 (秒)")
+    parser.add_argument("--first-token-latency", type=float, default=settings["first_token_latency"])
+    parser.add_argument("--tokens-per-second", type=float, default=settings["tokens_per_second"])
+    parser.add_argument("--reply-tokens", type=int, default=fakes.settings["reply_tokens"])
+    parser.add_argument("--embed-latency", type=float, default=settings["embed_latency"])
+    parser.add_argument("--parallel", type=int, default=settings["parallel"])
+    parser.add_argument("--dim", type=int, default=settings["dim"])
+    args = parser.parse_args(argv)
+    settings.update({
+        "load_latency": args.load_latency,
+        "first_token_latency": args.first_token_latency,
+        "tokens_per_second": args.tokens_per_second,
+        "embed_latency": args.embed_latency,
+        "parallel": args.parallel,
+        "dim": args.dim,
+    })
+    fakes.settings["reply_tokens"] = args.reply_tokens
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    # python -m benchmarks.mock_ollama --port 11500 --parallel 4
+    main()
@@ -0,0 +1,137 @@
+import math
+import os
+import pickle
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+CJK_RANGES = "\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af"
+TOKEN_PATTERN = re.compile(f"[a-z0-9]+|[{CJK_RANGES}]+")
+CJK_PATTERN = re.compile(f"[{CJK_RANGES}]")
+
+
+def tokenize(text):
+    # 英文与数字按词切分; 中日韩文本没有空格, 用单字加相邻二字组合
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if CJK_PATTERN.match(token):
+            tokens.extend(token)
+            tokens.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            tokens.append(token)
+    return tokens
+
+
+class BM25Index:
+    # 子文档的 BM25 倒排索引, 常驻内存, 用 pickle 持久化
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.docs = {}  # child_id -> (parent_id, text, length)
+        self.postings = {}  # term -> {child_id: tf}
+        self.total_length = 0
+        self._arrays = None
+
+    def __getstate__(self):
+        # 查询用的数组由倒排表推导, 不写入 pickle
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault("_arrays", None)
+
+    def compile(self):
+        # 把倒排表转成数组: 每个词对应 (行号, 该词在这些行上的 BM25 分数); 之后的查询只做向量化的累加
+        if self._arrays is not None:
+            return self._arrays
+        child_ids = list(self.docs)
+        row_of = {child_id: row for row, child_id in enumerate(child_ids)}
+        n = len(child_ids)
+        avg_length = self.total_length / n if n else 0.0
+        lengths = np.array([self.docs[child_id][2] for child_id in child_ids], dtype=np.float32)
+        norms = self.k1 * (1 - self.b + self.b * lengths / avg_length) if n else lengths
+        terms = {}
+        for term, posting in self.postings.items():
+            rows = np.fromiter((row_of[child_id] for child_id in posting), dtype=np.int32, count=len(posting))
+            tf = np.fromiter(posting.values(), dtype=np.float32, count=len(posting))
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            terms[term] = (rows, (idf * tf * (self.k1 + 1) / (tf + norms[rows])).astype(np.float32))
+        self._arrays = (child_ids, terms)
+        return self._arrays
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, ids, texts, parent_ids):
+        self._arrays = None
+        for child_id, text, parent_id in zip(ids, texts, parent_ids):
+            if child_id in self.docs:
+                self.remove([child_id])
+            counts = Counter(tokenize(text))
+            length = sum(counts.values())
+            self.docs[child_id] = (parent_id, text, length)
+            self.total_length += length
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[child_id] = tf
+
+    def remove(self, ids):
+        self._arrays = None
+        for child_id in ids:
+            doc = self.docs.pop(child_id, None)
+            if doc is None:
+                continue
+            parent_id, text, length = doc
+            self.total_length -= length
+            for term in set(tokenize(text)):
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(child_id, None)
+                    if not posting:
+                        del self.postings[term]
+
+    def clear(self):
+        self.docs.clear()
+        self.postings.clear()
+        self.total_length = 0
+        self._arrays = None
+
+    def search(self, query, k=3, max_df=0.5):
+        # 返回 [(child_id, parent_id, text, score)], 分数从高到低
+        # 出现在超过 max_df 比例子文档中的词 (停用词) 的 idf 接近 0, 倒排表却最长; 查询中还有其它词时跳过它们
+        if not self.docs:
+            return []
+        child_ids, terms = self.compile()
+        entries = [terms[term] for term in set(tokenize(query)) if term in terms]
+        rare = [entry for entry in entries if len(entry[0]) <= max_df * len(child_ids)]
+        entries = rare or entries
+        if not entries:
+            return []
+        scores = np.zeros(len(child_ids), dtype=np.float32)
+        for rows, weights in entries:
+            scores[rows] += weights
+        # 对布尔数组取非零下标比直接对浮点数组快得多; BM25 分数非负, 大于 0 即为命中
+        matched = np.flatnonzero(scores > 0)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        top = matched[np.argsort(-scores[matched], kind="stable")]
+        return [
+            (child_ids[row], self.docs[child_ids[row]][0], self.docs[child_ids[row]][1], float(scores[row]))
+            for row in top
+        ]
+
+    def save(self, path):
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return pickle.load(f)
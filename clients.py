@@ -0,0 +1,170 @@
+import os
+import threading
+
+import httpx
+from dotenv import load_dotenv
+from langchain_ollama import ChatOllama, OllamaEmbeddings
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+
+from balancer import BalancedChatModel, BalancedEmbeddings, Endpoint, create_balancer, split_endpoints
+
+load_dotenv()
+
+# 进程内共享的模型客户端: 相同 (provider, 模型, 地址, 参数) 只创建一次,
+# 同一地址的所有客户端共用一个 HTTP 连接池, 保持长连接
+_lock = threading.Lock()
+_clients = {}
+_pools = {}
+_stats = {"created": 0, "reused": 0}
+
+
+def pool_limits():
+    return httpx.Limits(
+        max_connections=int(os.getenv("HTTP_MAX_CONNECTIONS", "100")),
+        max_keepalive_connections=int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")),
+    )
+
+
+def http_timeout():
+    # 默认不限制读取时间, system 2 模型生成可能持续数分钟; 只限制建立连接的时间
+    return httpx.Timeout(None, connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "10")))
+
+
+def _shared(key, factory):
+    with _lock:
+        value = _pools.get(key)
+        if value is None:
+            value = _pools[key] = factory()
+        return value
+
+
+def shared_transport(base_url, asynchronous=False):
+    # 同一地址的同步 / 异步请求各共用一个连接池
+    if asynchronous:
+        return _shared(("transport", "async", base_url), lambda: httpx.AsyncHTTPTransport(limits=pool_limits()))
+    return _shared(("transport", "sync", base_url), lambda: httpx.HTTPTransport(limits=pool_limits()))
+
+
+def shared_http_client(base_url, asynchronous=False):
+    # OpenAI SDK 直接接收 httpx 客户端
+    transport = shared_transport(base_url, asynchronous)
+    if asynchronous:
+        return _shared(("client", "async", base_url), lambda: httpx.AsyncClient(transport=transport, timeout=http_timeout()))
+    return _shared(("client", "sync", base_url), lambda: httpx.Client(transport=transport, timeout=http_timeout()))
+
+
+def _get(key, factory):
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _stats["reused"] += 1
+            return client
+    client = factory()
+    with _lock:
+        # 并发创建时只保留先注册的那个
+        if key in _clients:
+            _stats["reused"] += 1
+            return _clients[key]
+        _clients[key] = client
+        _stats["created"] += 1
+        return client
+
+
+def _key(kind, provider, model, base_url, api_key, params):
+    return (kind, provider, model, base_url, api_key, tuple(sorted(params.items())))
+
+
+def health_check(provider, api_key):
+    # 返回 (按端点地址生成健康检查 URL 的函数, 请求头)
+    if provider == "ollama":
+        return (lambda url: f"{url.rstrip('/')}/api/version"), {}
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    return (lambda url: f"{url.rstrip('/')}/models"), headers
+
+
+def create_balanced(kind, provider, model, urls, api_key, build):
+    # 每个端点一个 (同样被缓存的) 客户端, 由负载均衡器在它们之间分发请求
+    health_url, headers = health_check(provider, api_key)
+    endpoints = [Endpoint(url, build(url)) for url in urls]
+    return create_balancer(f"{kind}:{provider}:{model}", endpoints, health_url=health_url, headers=headers)
+
+
+def get_chat_model(provider, model, base_url=None, api_key=None, **params):
+    # base_url 为逗号分隔的多个地址时返回负载均衡的模型
+    urls = split_endpoints(base_url)
+    if urls is not None:
+        def factory():
+            balancer = create_balanced(
+                "chat", provider, model, urls, api_key,
+                lambda url: get_chat_model(provider, model, url, api_key, **params),
+            )
+            return BalancedChatModel(model=model, balancer=balancer)
+    elif provider == "ollama":
+        def factory():
+            return ChatOllama(
+                model=model,
+                base_url=base_url,
+                sync_client_kwargs={"transport": shared_transport(base_url)},
+                async_client_kwargs={"transport": shared_transport(base_url, asynchronous=True)},
+                **params,
+            )
+    elif provider == "openai":
+        def factory():
+            return ChatOpenAI(
+                model=model,
+                api_key=api_key,
+                base_url=base_url,
+                http_client=shared_http_client(base_url),
+                http_async_client=shared_http_client(base_url, asynchronous=True),
+                **params,
+            )
+    else:
+        raise ValueError(f"Unsupported model type: {provider}. Use 'ollama' or 'openai'.")
+    return _get(_key("chat", provider, model, base_url, api_key, params), factory)
+
+
+def get_embeddings(provider, model, base_url=None, api_key=None, **params):
+    urls = split_endpoints(base_url)
+    if urls is not None:
+        def factory():
+            balancer = create_balanced(
+                "embeddings", provider, model, urls, api_key,
+                lambda url: get_embeddings(provider, model, url, api_key, **params),
+            )
+            return BalancedEmbeddings(balancer)
+    elif provider == "ollama":
+        def factory():
+            return OllamaEmbeddings(
+                model=model,
+                base_url=base_url,
+                sync_client_kwargs={"transport": shared_transport(base_url)},
+                async_client_kwargs={"transport": shared_transport(base_url, asynchronous=True)},
+                **params,
+            )
+    elif provider == "openai":
+        def factory():
+            return OpenAIEmbeddings(
+                model=model,
+                api_key=api_key,
+                base_url=base_url,
+                http_client=shared_http_client(base_url),
+                http_async_client=shared_http_client(base_url, asynchronous=True),
+                **params,
+            )
+    else:
+        raise ValueError(f"Unsupported embedding model type: {provider}. Use 'ollama' or 'openai'.")
+    return _get(_key("embeddings", provider, model, base_url, api_key, params), factory)
+
+
+def stats():
+    with _lock:
+        return {"clients": len(_clients), "pools": len(_pools), **_stats}
+
+
+def clear():
+    # 基准测试替换模型构造函数后调用, 让之后的 agent 重新创建客户端
+    with _lock:
+        _clients.clear()
+        _pools.clear()
+        _stats.update(created=0, reused=0)
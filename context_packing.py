@@ -0,0 +1,92 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 每个子文档命中位置前后保留的字符数
+WINDOW_CHARS = int(os.getenv("CONTEXT_WINDOW_CHARS", "400"))
+
+
+def token_budget(req_think=False):
+    # system 1 与 system 2 模型的上下文长度不同, 分别配置
+    if req_think:
+        return int(os.getenv("RESPONDER_CONTEXT_TOKENS_2", "3000"))
+    return int(os.getenv("RESPONDER_CONTEXT_TOKENS_1", "1500"))
+
+
+def is_cjk(char):
+    return "\u3040" <= char <= "\u30ff" or "\u3400" <= char <= "\u9fff" or "\uac00" <= char <= "\ud7af"
+
+
+def estimate_tokens(text):
+    # 不依赖具体模型的分词器: 中日韩字符约 1 token/字, 其他文本约 4 字符/token
+    cjk = sum(is_cjk(c) for c in text)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def build_windows(results, window_chars=WINDOW_CHARS):
+    # results: [{"id", "parent", "hits": [(子文档文本, 相关度)], "dense_score"}]
+    # 返回按相关度排序的片段 [{"id", "text", "score"}], 同一父文档内重叠的窗口会合并
+    windows = []
+    seen_parents = set()
+    for result in results:
+        parent_text = result["parent"].page_content
+        if parent_text in seen_parents:
+            continue
+        seen_parents.add(parent_text)
+
+        spans = []
+        for child_text, score in result["hits"]:
+            start = parent_text.find(child_text)
+            if start < 0:
+                start, end = 0, min(len(parent_text), len(child_text))
+            else:
+                end = start + len(child_text)
+            spans.append([max(0, start - window_chars), min(len(parent_text), end + window_chars), score])
+        if not spans:
+            spans.append([0, min(len(parent_text), 2 * window_chars), 0.0])
+
+        spans.sort()
+        merged = [spans[0]]
+        for start, end, score in spans[1:]:
+            last = merged[-1]
+            if start <= last[1]:
+                last[1] = max(last[1], end)
+                last[2] = max(last[2], score)
+            else:
+                merged.append([start, end, score])
+
+        for start, end, score in merged:
+            windows.append({"id": result["id"], "text": parent_text[start:end], "score": score})
+
+    windows.sort(key=lambda w: w["score"], reverse=True)
+
+    # 相邻父文档之间有少量重叠, 去掉被其他片段完整包含的片段
+    packed = []
+    for window in windows:
+        if any(window["text"] in other["text"] for other in packed):
+            continue
+        packed.append(window)
+    return packed
+
+
+def pack_context(windows, budget):
+    # 按相关度依次放入片段, 直到达到 token 预算
+    parts = []
+    used = 0
+    for window in windows:
+        text = window["text"]
+        tokens = estimate_tokens(text)
+        if used + tokens > budget:
+            remaining = budget - used
+            if remaining <= 0:
+                break
+            # 按比例截断最后一个片段
+            text = text[:max(1, len(text) * remaining // tokens)]
+            tokens = remaining
+        parts.append(text)
+        used += tokens
+        if used >= budget:
+            break
+    return "\n\n".join(parts)
@@ -1,13 +1,18 @@
+import argparse
+import hashlib
+import json
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from pathlib import Path
 import fitz
 from langchain.docstore.document import Document
-from langchain.retrievers import ParentDocumentRetriever
-from langchain.storage import LocalFileStore
-from langchain.storage._lc_store import create_kv_docstore
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_chroma import Chroma
-from langchain_ollama import OllamaEmbeddings
-from langchain_openai import OpenAIEmbeddings  # 添加 OpenAI 支持
+
+from bm25 import BM25Index
+from docstore import create_docstore
+from embeddings import create_embedding_function
+from kb_version import bump_kb_version
+from vectorstores import FlatVectorStore, count_vectors, create_vectorstore
 
 import os
 from dotenv import load_dotenv
@@ -23,7 +28,12 @@ embedding_model_openai = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada
 
 # PDF 文件目录
 doc_dir = "knowledge_base/pdf"
-pdf_paths = sorted(list(Path(doc_dir).glob("*.pdf")))
+# 记录每个 PDF 的内容哈希以及由它生成的父/子文档 ID, 用于增量更新
+manifest_path = Path(os.getenv("KB_MANIFEST_PATH", "knowledge_base/manifest.json"))
+# 正在写入、还没有记入 manifest 的父/子文档 ID, 每批写入前追加一行; 中途退出后下次运行据此删除残留
+pending_path = manifest_path.with_name(manifest_path.stem + ".pending.jsonl")
+# 子文档的 BM25 倒排索引, 与向量检索一起做混合检索
+lexical_index_path = Path(os.getenv("LEXICAL_INDEX_PATH", "knowledge_base/bm25.pkl"))
 
 # 定义分片器
 parent_splitter = RecursiveCharacterTextSplitter(
@@ -34,55 +44,248 @@ child_splitter = RecursiveCharacterTextSplitter(
     chunk_size=250,
     chunk_overlap=25,
 )
+# 与 ParentDocumentRetriever 默认的 id_key 保持一致
+id_key = "doc_id"
+# PDF 解析进程数, 以及每次写入向量库的子文档数量
+ingest_workers = int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1)))
+ingest_batch_size = int(os.getenv("INGEST_BATCH_SIZE", "256"))
 
-# 设置存储
-fs = LocalFileStore("knowledge_base/local_file_store")
-store = create_kv_docstore(fs)
 
-# 动态选择嵌入模型
-if model_type == "ollama":
-    embedding_function = OllamaEmbeddings(
-        model=embedding_model_ollama,
-        base_url=ollama_base_url
-    )
-elif model_type == "openai":
-    embedding_function = OpenAIEmbeddings(
-        model=embedding_model_openai,
-        api_key=openai_api_key,
-        base_url=openai_base_url
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest():
+    if not manifest_path.exists():
+        return {}
+    return json.loads(manifest_path.read_text(encoding="utf-8"))
+
+
+def save_manifest(manifest):
+    # 先写临时文件再替换, 中途退出也不会留下半个 manifest
+    tmp_path = manifest_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp_path.replace(manifest_path)
+
+
+def append_pending(parent_ids, child_ids):
+    with open(pending_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"parent_ids": parent_ids, "child_ids": child_ids}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def clear_pending():
+    pending_path.unlink(missing_ok=True)
+
+
+def remove_pending(vectorstore, store, lexical_index):
+    # 上次运行在写完某个文件之前退出: 删除已写入但不在 manifest 中的向量、BM25 条目和父文档
+    if not pending_path.exists():
+        return
+    parent_ids = []
+    child_ids = []
+    for line in pending_path.read_text(encoding="utf-8").splitlines():
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue  # 写到一半的最后一行, 对应的批次还没有写入
+        parent_ids.extend(entry["parent_ids"])
+        child_ids.extend(entry["child_ids"])
+    remove_document(vectorstore, store, lexical_index, {"parent_ids": parent_ids, "child_ids": child_ids})
+    clear_pending()
+    print(f"已清理上次中断留下的 {len(parent_ids)} 个父文档, {len(child_ids)} 个子文档")
+
+
+def iter_pdf_pages(path):
+    with fitz.open(str(path)) as pdf_doc:
+        for page in pdf_doc:
+            yield page.get_text()
+
+
+def extract_text(path):
+    # 在子进程中执行, 用 join 代替逐页 += 拼接
+    return "".join(iter_pdf_pages(path))
+
+
+def extract_in_pool(paths, workers=ingest_workers):
+    # 按完成顺序产出 (path, text), 同时在处理中的文件数不超过 2 * workers, 内存占用不随语料规模增长
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for path in paths:
+            pending[executor.submit(extract_text, path)] = path
+            if len(pending) >= 2 * workers:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                yield path, future.result()
+                next_path = next(paths, None)
+                if next_path is not None:
+                    pending[executor.submit(extract_text, next_path)] = next_path
+
+
+def iter_chunks(text, source):
+    # 与 ParentDocumentRetriever.add_documents 相同的切分方式, 但保留父/子文档 ID 以便之后删除
+    for parent_text in parent_splitter.split_text(text):
+        parent_id = str(uuid.uuid4())
+        parent_doc = Document(page_content=parent_text, metadata={"source": source})
+        child_docs = []
+        for child_doc in child_splitter.split_documents([parent_doc]):
+            child_doc.metadata[id_key] = parent_id
+            child_docs.append(child_doc)
+        yield parent_id, parent_doc, child_docs
+
+
+def index_document(vectorstore, store, lexical_index, text, source, batch_size=ingest_batch_size):
+    parent_ids = []
+    child_ids = []
+    parent_batch = []
+    child_batch = []
+
+    def flush():
+        batch_ids = [str(uuid.uuid4()) for _ in child_batch]
+        # 先记下本批的 ID 再写入, 保证写入的数据总能被找到并删除
+        if batch_ids or parent_batch:
+            append_pending([parent_id for parent_id, _ in parent_batch], batch_ids)
+        if child_batch:
+            vectorstore.add_documents(child_batch, ids=batch_ids)
+            lexical_index.add(
+                batch_ids,
+                [d.page_content for d in child_batch],
+                [d.metadata[id_key] for d in child_batch],
+            )
+            child_ids.extend(batch_ids)
+            child_batch.clear()
+        if parent_batch:
+            store.mset(parent_batch)
+            parent_batch.clear()
+
+    # 按批写入, 每批最多 batch_size 个子文档
+    for parent_id, parent_doc, child_docs in iter_chunks(text, source):
+        parent_ids.append(parent_id)
+        parent_batch.append((parent_id, parent_doc))
+        child_batch.extend(child_docs)
+        if len(child_batch) >= batch_size:
+            flush()
+    flush()
+    return parent_ids, child_ids
+
+
+def remove_document(vectorstore, store, lexical_index, entry):
+    if entry["child_ids"]:
+        vectorstore.delete(ids=entry["child_ids"])
+        lexical_index.remove(entry["child_ids"])
+    if entry["parent_ids"]:
+        store.mdelete(entry["parent_ids"])
+
+
+def clear_index(vectorstore, store, lexical_index):
+    vectorstore.reset_collection()
+    store.mdelete(list(store.yield_keys()))
+    lexical_index.clear()
+
+
+def load_lexical_index(vectorstore, manifest, lexical_index, batch_size=5_000):
+    child_ids = [child_id for entry in manifest.values() for child_id in entry["child_ids"]]
+    if len(lexical_index) == len(child_ids):
+        return lexical_index
+
+    # 上次运行中途退出或首次启用时, 从向量库中的子文档重建 BM25 索引
+    print("BM25 索引与 manifest 不一致, 从向量库重建")
+    lexical_index.clear()
+    for i in range(0, len(child_ids), batch_size):
+        batch = vectorstore.get(ids=child_ids[i:i + batch_size], include=["documents", "metadatas"])
+        lexical_index.add(
+            batch["ids"],
+            batch["documents"],
+            [metadata[id_key] for metadata in batch["metadatas"]],
+        )
+    return lexical_index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="增量构建知识库向量存储")
+    parser.add_argument("--rebuild", action="store_true", help="清空向量库与文档库后全量重建")
+    args = parser.parse_args(argv)
+
+    # 设置存储 (DOCSTORE_BACKEND=file 或 sqlite)
+    store = create_docstore()
+
+    # 动态选择嵌入模型 (带批处理、并发控制和磁盘缓存)
+    embedding_function = create_embedding_function(
+        model_type,
+        ollama_base_url=ollama_base_url,
+        openai_api_key=openai_api_key,
+        openai_base_url=openai_base_url,
     )
-else:
-    raise ValueError(f"Unsupported embedding model type: {model_type}. Use 'ollama' or 'openai'.")
-
-# 初始化向量存储
-vectorstore = Chroma(
-    collection_name="parent_docs",
-    embedding_function=embedding_function,
-    persist_directory="knowledge_base/vectorstore",
-)
 
-# 设置检索器
-retriever = ParentDocumentRetriever(
-    vectorstore=vectorstore,
-    docstore=store,
-    child_splitter=child_splitter,
-    parent_splitter=parent_splitter,
-    search_kwargs={"k": 1},
-)
+    # 初始化向量存储 (VECTORSTORE_BACKEND=chroma 或 flat)
+    vectorstore = create_vectorstore(embedding_function)
+
+    manifest = load_manifest()
+    if args.rebuild:
+        lexical_index = BM25Index()
+        clear_index(vectorstore, store, lexical_index)
+        clear_pending()
+        manifest = {}
+    else:
+        lexical_index = BM25Index.load(lexical_index_path) if lexical_index_path.exists() else BM25Index()
+        remove_pending(vectorstore, store, lexical_index)
+        if not manifest and count_vectors(vectorstore) > 0:
+            raise SystemExit(
+                "向量库中已有未被 manifest 记录的数据, 无法增量更新; 请使用 --rebuild 全量重建一次。"
+            )
+        lexical_index = load_lexical_index(vectorstore, manifest, lexical_index)
+
+    pdf_paths = sorted(list(Path(doc_dir).glob("*.pdf")))
+    current = {p.as_posix(): p for p in pdf_paths}
+    changed = False
+
+    # 删除已经不存在的文件对应的向量和父文档
+    for source in sorted(set(manifest) - set(current)):
+        remove_document(vectorstore, store, lexical_index, manifest.pop(source))
+        save_manifest(manifest)
+        changed = True
+        print(f"已删除: {source}")
+
+    # 只处理新增或内容有变化的文件
+    pending = {}
+    for source, path in current.items():
+        digest = file_hash(path)
+        entry = manifest.get(source)
+        if entry is None or entry["sha256"] != digest:
+            pending[path] = (source, digest)
+
+    for path, text in extract_in_pool(list(pending)):
+        source, digest = pending[path]
+        entry = manifest.get(source)
+        if entry is not None:
+            remove_document(vectorstore, store, lexical_index, entry)
+        parent_ids, child_ids = index_document(vectorstore, store, lexical_index, text, source)
+        manifest[source] = {"sha256": digest, "parent_ids": parent_ids, "child_ids": child_ids}
+        save_manifest(manifest)
+        clear_pending()
+        changed = True
+        print(f"{'已更新' if entry is not None else '已添加'}: {source} ({len(parent_ids)} 个父文档, {len(child_ids)} 个子文档)")
 
-# 处理 PDF 文件
-docs = []
-for p in pdf_paths:
-    pdf_doc = fitz.open(str(p))
-    pdf_str = ""
-    for page in pdf_doc:
-        pdf_str += page.get_text()
+    print(f"嵌入缓存: {embedding_function.stats()}")
+    lexical_index.save(lexical_index_path)
+    if changed:
+        if isinstance(vectorstore, FlatVectorStore):
+            # 去掉删除留下的墓碑行, 重写为紧凑的矩阵文件
+            vectorstore.compact()
+        # 更新知识库版本号, 让语义缓存等依赖知识库的缓存失效
+        bump_kb_version()
 
-    # 创建 LangChain 文档
-    doc = Document(page_content=pdf_str)
-    docs.append(doc)
+    print(f"文档已处理并添加到检索器，使用模型类型: {model_type}, 嵌入模型: {embedding_model_ollama if model_type == 'ollama' else embedding_model_openai}")
 
-# 将文档添加到检索器
-retriever.add_documents(docs)
 
-print(f"文档已处理并添加到检索器，使用模型类型: {model_type}, 嵌入模型: {embedding_model_ollama if model_type == 'ollama' else embedding_model_openai}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
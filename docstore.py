@@ -0,0 +1,107 @@
+import argparse
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from dotenv import load_dotenv
+from langchain.storage import LocalFileStore
+from langchain.storage._lc_store import create_kv_docstore
+from langchain_core.stores import BaseStore
+
+load_dotenv()
+
+
+class SQLiteStore(BaseStore[str, bytes]):
+    # 所有父文档存放在同一个 SQLite 文件中, mget/mset 每批只需一次查询
+    def __init__(self, path="knowledge_base/docstore.sqlite", batch_size=500):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+        self._conn.commit()
+
+    def _chunks(self, items):
+        for i in range(0, len(items), self.batch_size):
+            yield items[i:i + self.batch_size]
+
+    def mget(self, keys):
+        keys = list(keys)
+        found = {}
+        with self._lock:
+            for chunk in self._chunks(keys):
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, value FROM kv WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+                found.update(rows)
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", list(key_value_pairs)
+            )
+            self._conn.commit()
+
+    def mdelete(self, keys):
+        keys = list(keys)
+        with self._lock:
+            for chunk in self._chunks(keys):
+                placeholders = ",".join("?" * len(chunk))
+                self._conn.execute(f"DELETE FROM kv WHERE key IN ({placeholders})", chunk)
+            self._conn.commit()
+
+    def yield_keys(self, prefix=None):
+        with self._lock:
+            if prefix is None:
+                rows = self._conn.execute("SELECT key FROM kv").fetchall()
+            else:
+                rows = self._conn.execute(
+                    "SELECT key FROM kv WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)
+                ).fetchall()
+        for (key,) in rows:
+            yield key
+
+
+def create_byte_store(backend=None):
+    backend = (backend or os.getenv("DOCSTORE_BACKEND", "file")).lower()
+    if backend == "file":
+        return LocalFileStore(os.getenv("DOCSTORE_FILE_PATH", "knowledge_base/local_file_store"))
+    if backend == "sqlite":
+        return SQLiteStore(os.getenv("DOCSTORE_SQLITE_PATH", "knowledge_base/docstore.sqlite"))
+    raise ValueError(f"Unsupported docstore backend: {backend}. Use 'file' or 'sqlite'.")
+
+
+def create_docstore(backend=None):
+    return create_kv_docstore(create_byte_store(backend))
+
+
+def migrate(source, target, batch_size=1_000):
+    # 原样复制已序列化的字节, 不需要反序列化父文档
+    batch = []
+    count = 0
+    for key in source.yield_keys():
+        batch.append(key)
+        if len(batch) >= batch_size:
+            target.mset(zip(batch, source.mget(batch)))
+            count += len(batch)
+            batch = []
+    if batch:
+        target.mset(zip(batch, source.mget(batch)))
+        count += len(batch)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把 LocalFileStore 中的父文档迁移到 SQLite 文档库")
+    parser.add_argument("--source", default=os.getenv("DOCSTORE_FILE_PATH", "knowledge_base/local_file_store"))
+    parser.add_argument("--target", default=os.getenv("DOCSTORE_SQLITE_PATH", "knowledge_base/docstore.sqlite"))
+    args = parser.parse_args()
+
+    count = migrate(LocalFileStore(args.source), SQLiteStore(args.target))
+    print(f"已迁移 {count} 个父文档到 {args.target}, 设置 DOCSTORE_BACKEND=sqlite 即可启用")
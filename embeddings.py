@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+
+from clients import get_embeddings
+
+load_dotenv()
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class CachedEmbeddings(Embeddings):
+    # 包装任意 Embeddings: 按批次并发请求, 并把结果按 (模型名, 文本哈希) 缓存到 SQLite
+    def __init__(self, embeddings, model_name, cache_path="knowledge_base/embedding_cache.sqlite",
+                 batch_size=64, max_concurrency=4):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+        self._lock = threading.Lock()
+        self._conn = None
+        if cache_path:
+            Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, kind, key)
+                )
+                """
+            )
+            self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def _cache_get(self, kind, keys):
+        found = {}
+        if self._conn is None:
+            return found
+        with self._lock:
+            # SQLite 单条语句的参数数量有限, 分段查询
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE model = ? AND kind = ? AND key IN ({placeholders})",
+                    (self.model_name, kind, *chunk),
+                ).fetchall()
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def _cache_put(self, kind, items):
+        if self._conn is None or not items:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, kind, key, vector) VALUES (?, ?, ?, ?)",
+                [
+                    (self.model_name, kind, key, np.asarray(vector, dtype=np.float32).tobytes())
+                    for key, vector in items
+                ],
+            )
+            self._conn.commit()
+
+    def _lookup(self, kind, texts):
+        keys = [text_hash(text) for text in texts]
+        cached = self._cache_get(kind, list(set(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing.setdefault(key, text)
+        miss_count = sum(key not in cached for key in keys)
+        with self._lock:
+            self.hits += len(keys) - miss_count
+            self.misses += miss_count
+        return keys, cached, missing
+
+    def _batches(self, missing):
+        items = list(missing.items())
+        return [items[i:i + self.batch_size] for i in range(0, len(items), self.batch_size)]
+
+    def embed_documents(self, texts):
+        keys, cached, missing = self._lookup("document", texts)
+        if missing:
+            batches = self._batches(missing)
+            results = self.executor.map(
+                lambda batch: self.embeddings.embed_documents([text for _, text in batch]),
+                batches,
+            )
+            for batch, vectors in zip(batches, results):
+                new_items = [(key, vector) for (key, _), vector in zip(batch, vectors)]
+                self._cache_put("document", new_items)
+                cached.update(new_items)
+        return [cached[key] for key in keys]
+
+    async def aembed_documents(self, texts):
+        keys, cached, missing = self._lookup("document", texts)
+        if missing:
+            semaphore = asyncio.Semaphore(self.max_concurrency)
+
+            async def embed_batch(batch):
+                async with semaphore:
+                    return await self.embeddings.aembed_documents([text for _, text in batch])
+
+            batches = self._batches(missing)
+            results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+            for batch, vectors in zip(batches, results):
+                new_items = [(key, vector) for (key, _), vector in zip(batch, vectors)]
+                self._cache_put("document", new_items)
+                cached.update(new_items)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        keys, cached, missing = self._lookup("query", [text])
+        if missing:
+            vector = self.embeddings.embed_query(text)
+            self._cache_put("query", [(keys[0], vector)])
+            return vector
+        return cached[keys[0]]
+
+    async def aembed_query(self, text):
+        keys, cached, missing = self._lookup("query", [text])
+        if missing:
+            vector = await self.embeddings.aembed_query(text)
+            self._cache_put("query", [(keys[0], vector)])
+            return vector
+        return cached[keys[0]]
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+def create_embedding_function(model_type, ollama_base_url=None, openai_api_key=None, openai_base_url=None):
+    if model_type == "ollama":
+        model_name = os.getenv("OLLAMA_EMBEDDING_MODEL", "nomic-embed-text:latest")
+        embeddings = get_embeddings(
+            "ollama",
+            model=model_name,
+            base_url=ollama_base_url or "http://localhost:11434",
+        )
+    elif model_type == "openai":
+        model_name = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-ada-002")
+        embeddings = get_embeddings(
+            "openai",
+            model=model_name,
+            api_key=openai_api_key,
+            base_url=openai_base_url,
+        )
+    else:
+        raise ValueError(f"Unsupported embedding model type: {model_type}. Use 'ollama' or 'openai'.")
+
+    cache_path = None
+    if os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true":
+        cache_path = os.getenv("EMBEDDING_CACHE_PATH", "knowledge_base/embedding_cache.sqlite")
+    return CachedEmbeddings(
+        embeddings,
+        f"{model_type}:{model_name}",
+        cache_path=cache_path,
+        batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "64")),
+        max_concurrency=int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "4")),
+    )
@@ -1,14 +1,43 @@
+import os
+import threading
+
+from dotenv import load_dotenv
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import END, StateGraph
 
 from agents.responder import ResponderAgent
 from agents.retriever import RetrieverAgent
 from agents.router import RouterAgent
+from memory import create_memory
+from semantic_cache import SemanticCache, replay
 from state import AgentGraphState
+from tracing import finish_trace, span, start_trace, trace_config
+from warmup import create_model_warmer
+
+load_dotenv()
 
-router_agent = RouterAgent()
 retriever_agent = RetrieverAgent()
+router_agent = RouterAgent(embedding_function=retriever_agent.embedding_function)
 responder_agent = ResponderAgent()
 
+# 对话记忆: 最近几轮原样保留, 更早的轮次由 router 模型增量摘要
+conversation_memory = create_memory(router_agent.llm)
+
+# 模型预热 (可选): 后台预加载所有 Ollama 模型并在 keep_alive 到期前重新预热
+model_warmer = create_model_warmer(router_agent, retriever_agent, responder_agent)
+if model_warmer is not None:
+    model_warmer.start()
+
+
+ROUTER_KEYS = (
+    "router_need_retriever",
+    "router_need_retriever_reason",
+    "router_need_system_2",
+    "router_need_system_2_reason",
+)
+RETRIEVER_KEYS = ("search_terms", "retrieved_passages", "retrieved_info")
+RESPONDER_KEYS = ("responder_reply",)
+
 
 def check_require_RAG(state: AgentGraphState):
     if state["router_need_retriever"]:
@@ -17,25 +46,216 @@ def check_require_RAG(state: AgentGraphState):
         return "responder"
 
 
+def only_keys(result, keys):
+    # 并行分支只能返回各自写入的字段, 否则同一步内会重复更新 question 等字段
+    return {k: result[k] for k in keys if k in result}
+
+
+def node(name, func, afunc):
+    # 同一节点同时提供同步和异步实现, workflow.stream 与 workflow.astream 都可以使用
+    # 每个节点的耗时记录到当前请求的 trace
+    def run(state):
+        with span(f"node.{name}"):
+            return func(state)
+
+    async def arun(state):
+        with span(f"node.{name}"):
+            return await afunc(state)
+
+    return RunnableLambda(run, afunc=arun, name=name)
+
+
+def speculative_dispatch(state: AgentGraphState):
+    return {"cancel_retrieval": threading.Event()}
+
+
+def speculative_router(state: AgentGraphState):
+    updates = only_keys(router_agent.invoke(dict(state)), ROUTER_KEYS)
+    if not updates.get("router_need_retriever"):
+        # 不需要检索, 通知仍在进行的检索尽快停止
+        state["cancel_retrieval"].set()
+    return updates
+
+
+async def aspeculative_router(state: AgentGraphState):
+    updates = only_keys(await router_agent.ainvoke(dict(state)), ROUTER_KEYS)
+    if not updates.get("router_need_retriever"):
+        state["cancel_retrieval"].set()
+    return updates
+
+
+def speculative_retriever(state: AgentGraphState):
+    return only_keys(retriever_agent.invoke(dict(state)), RETRIEVER_KEYS)
+
+
+async def aspeculative_retriever(state: AgentGraphState):
+    return only_keys(await retriever_agent.ainvoke(dict(state)), RETRIEVER_KEYS)
+
+
+def discard_unneeded_context(state: AgentGraphState):
+    state = dict(state)
+    if not state.get("router_need_retriever"):
+        # 路由判断不需要检索时丢弃推测检索的结果
+        state["retrieved_passages"] = []
+        state["retrieved_info"] = ""
+    return state
+
+
+def speculative_responder(state: AgentGraphState):
+    state = discard_unneeded_context(state)
+    return only_keys(responder_agent.invoke(state), RESPONDER_KEYS)
+
+
+async def aspeculative_responder(state: AgentGraphState):
+    state = discard_unneeded_context(state)
+    return only_keys(await responder_agent.ainvoke(state), RESPONDER_KEYS)
+
+
 # structure
 graph = StateGraph(AgentGraphState)
+graph_mode = os.getenv("GRAPH_MODE", "serial").lower()
 
-graph.add_node("router", lambda state: router_agent.invoke(state))
-graph.add_node("retriever", lambda state: retriever_agent.invoke(state))
-graph.add_node("responder", lambda state: responder_agent.invoke(state))
+if graph_mode == "serial":
+    graph.add_node("router", node("router", router_agent.invoke, router_agent.ainvoke))
+    graph.add_node("retriever", node("retriever", retriever_agent.invoke, retriever_agent.ainvoke))
+    graph.add_node("responder", node("responder", responder_agent.invoke, responder_agent.ainvoke))
 
-# flow
-graph.set_entry_point("router")
-graph.add_conditional_edges(
-    "router",
-    check_require_RAG,
-    {"retriever": "retriever", "responder": "responder"},
-)
-graph.add_edge("retriever", "responder")
-graph.add_edge("responder", END)
+    # flow
+    graph.set_entry_point("router")
+    graph.add_conditional_edges(
+        "router",
+        check_require_RAG,
+        {"retriever": "retriever", "responder": "responder"},
+    )
+    graph.add_edge("retriever", "responder")
+    graph.add_edge("responder", END)
+elif graph_mode == "speculative":
+    # router 与 retriever 同时开始, responder 等两者都结束后再执行
+    graph.add_node("dispatch", speculative_dispatch)
+    graph.add_node("router", node("router", speculative_router, aspeculative_router))
+    graph.add_node("retriever", node("retriever", speculative_retriever, aspeculative_retriever))
+    graph.add_node("responder", node("responder", speculative_responder, aspeculative_responder))
+
+    # flow
+    graph.set_entry_point("dispatch")
+    graph.add_edge("dispatch", "router")
+    graph.add_edge("dispatch", "retriever")
+    graph.add_edge(["router", "retriever"], "responder")
+    graph.add_edge("responder", END)
+else:
+    raise ValueError(f"Unsupported graph mode: {graph_mode}. Use 'serial' or 'speculative'.")
 
 workflow = graph.compile()
 
+# 语义缓存 (可选): 相似问题直接回放之前的回答, 跳过 router/retriever/responder
+semantic_cache = None
+if os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true":
+    semantic_cache = SemanticCache(
+        retriever_agent.embedding_function,
+        path=os.getenv("SEMANTIC_CACHE_PATH", "knowledge_base/semantic_cache.sqlite"),
+        threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95")),
+        ttl=float(os.getenv("SEMANTIC_CACHE_TTL", "86400")),
+        max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "1000")),
+    )
+
+
+def stream_reply(question, history=None, summary=""):
+    trace, token = start_trace(question)
+    try:
+        yield from _stream_reply(question, history or [], summary, trace)
+    except Exception as e:
+        if trace is not None:
+            trace.error = repr(e)
+        raise
+    finally:
+        finish_trace(trace, token)
+
+
+def _stream_reply(question, history, summary, trace):
+    # 有对话历史时回答依赖上下文, 不读写语义缓存
+    use_cache = semantic_cache is not None and not history and not summary
+    vector = None
+    if use_cache:
+        with span("semantic_cache.lookup"):
+            vector = semantic_cache.embed(question)
+            cached_reply = semantic_cache.lookup(vector)
+        if cached_reply is not None:
+            if trace is not None:
+                trace.cache_hit = True
+            for chunk in replay(cached_reply):
+                if trace is not None:
+                    trace.mark_first_token()
+                yield chunk
+            return
+
+    chunks = []
+    for msg, metadata in workflow.stream(
+        {
+            "question": question,
+            "history": history,
+            "summary": summary,
+        },
+        config=trace_config(trace),
+        stream_mode="messages",
+    ):
+        if metadata["langgraph_node"] == "responder":
+            if msg.content and trace is not None:
+                trace.mark_first_token()
+            chunks.append(msg.content)
+            yield msg.content
+
+    if use_cache:
+        semantic_cache.store(question, vector, "".join(chunks))
+
+
+async def astream_reply(question, history=None, summary=""):
+    trace, token = start_trace(question)
+    try:
+        async for chunk in _astream_reply(question, history or [], summary, trace):
+            yield chunk
+    except Exception as e:
+        if trace is not None:
+            trace.error = repr(e)
+        raise
+    finally:
+        finish_trace(trace, token)
+
+
+async def _astream_reply(question, history, summary, trace):
+    use_cache = semantic_cache is not None and not history and not summary
+    vector = None
+    if use_cache:
+        with span("semantic_cache.lookup"):
+            vector = await semantic_cache.aembed(question)
+            cached_reply = semantic_cache.lookup(vector)
+        if cached_reply is not None:
+            if trace is not None:
+                trace.cache_hit = True
+            for chunk in replay(cached_reply):
+                if trace is not None:
+                    trace.mark_first_token()
+                yield chunk
+            return
+
+    chunks = []
+    async for msg, metadata in workflow.astream(
+        {
+            "question": question,
+            "history": history,
+            "summary": summary,
+        },
+        config=trace_config(trace),
+        stream_mode="messages",
+    ):
+        if metadata["langgraph_node"] == "responder":
+            if msg.content and trace is not None:
+                trace.mark_first_token()
+            chunks.append(msg.content)
+            yield msg.content
+
+    if use_cache:
+        semantic_cache.store(question, vector, "".join(chunks))
+
 if __name__ == "__main__":
     question = "who is the ceo of kredivo?"
     for msg, metadata in workflow.stream(
@@ -0,0 +1,51 @@
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# 知识库每次重建后写入新的版本号, 依赖知识库内容的缓存据此失效
+KB_VERSION_PATH = Path(os.getenv("KB_VERSION_PATH", "knowledge_base/kb_version"))
+# 请求路径上最多每隔这么多秒检查一次版本文件
+KB_VERSION_CHECK_INTERVAL = float(os.getenv("KB_VERSION_CHECK_INTERVAL", "1.0"))
+
+_lock = threading.Lock()
+_cached = {"checked": None, "stat": None, "version": ""}
+
+
+def read_kb_version():
+    try:
+        return KB_VERSION_PATH.read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return ""
+
+
+def current_kb_version():
+    # 缓存的版本号: 间隔内直接返回; 到期后只 stat 文件, mtime / inode / 大小变化时才重新读取
+    now = time.monotonic()
+    with _lock:
+        if _cached["checked"] is not None and now - _cached["checked"] < KB_VERSION_CHECK_INTERVAL:
+            return _cached["version"]
+        _cached["checked"] = now
+        try:
+            st = os.stat(KB_VERSION_PATH)
+            stat = (st.st_mtime_ns, st.st_ino, st.st_size)
+        except FileNotFoundError:
+            stat = None
+        if stat != _cached["stat"]:
+            _cached["stat"] = stat
+            _cached["version"] = read_kb_version() if stat is not None else ""
+        return _cached["version"]
+
+
+def bump_kb_version():
+    version = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    KB_VERSION_PATH.parent.mkdir(parents=True, exist_ok=True)
+    # 先写临时文件再替换, 读进程看到的 inode 随之变化
+    tmp_path = KB_VERSION_PATH.with_suffix(".tmp")
+    tmp_path.write_text(version, encoding="utf-8")
+    tmp_path.replace(KB_VERSION_PATH)
+    return version
@@ -0,0 +1,85 @@
+import sys
+import threading
+from collections import OrderedDict
+
+from tracing import metrics
+
+_MISSING = object()
+
+
+def document_size(doc):
+    # 粗略估算一个 Document 占用的内存
+    return sys.getsizeof(doc.page_content) + sys.getsizeof(doc.metadata) + 256
+
+
+class LRUCache:
+    # 同时按条目数和估算内存大小淘汰的 LRU 缓存, 线程安全; 指定 name 时命中、未命中与淘汰次数导出到 /metrics
+    def __init__(self, max_entries=1_024, max_bytes=64 * 1024 * 1024, sizeof=sys.getsizeof, name=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+        if self.name is not None:
+            result = "miss" if item is _MISSING else "hit"
+            metrics.inc("chatbot_cache_lookups_total", help="In-process cache lookups by result", cache=self.name, result=result)
+        return default if item is _MISSING else item[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        evicted = 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (value, size)
+            self.bytes += size
+            while len(self._data) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                evicted += 1
+            self.evictions += evicted
+        if evicted and self.name is not None:
+            metrics.inc("chatbot_cache_evictions_total", evicted, help="In-process cache evictions", cache=self.name)
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.bytes -= item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
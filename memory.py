@@ -0,0 +1,124 @@
+import os
+
+from dotenv import load_dotenv
+from langchain.prompts import ChatPromptTemplate
+
+from context_packing import estimate_tokens
+from tracing import span
+
+load_dotenv()
+
+SUMMARY_PROMPT_TEMPLATE = """
+# Task
+Progressively summarize the conversation between a user and an assistant. Add the new lines onto the current summary and return the new summary in at most {max_words} words.
+Keep names, numbers and facts the user may refer back to. Strictly Return your response with just the summary.
+
+Current summary:
+{summary}
+
+New lines of conversation:
+{new_lines}
+
+New summary:
+"""
+
+ROLES = {"user": "User", "assistant": "Assistant"}
+
+
+def truncate_tokens(text, budget):
+    # 按估算的 token 数截断, 避免单条超长消息撑大 prompt
+    tokens = estimate_tokens(text)
+    if tokens <= budget:
+        return text
+    return text[:max(1, len(text) * budget // tokens)].rstrip() + " ..."
+
+
+def format_lines(messages):
+    return "\n".join(f"{ROLES.get(m['role'], m['role'])}: {m['content']}" for m in messages)
+
+
+def format_conversation(history, summary=""):
+    # router / 检索词 / responder 的 prompt 共用的对话上下文; 没有历史时为空, prompt 与单轮对话时相同
+    if not history and not summary:
+        return ""
+    lines = ["# Conversation so far"]
+    if summary:
+        lines.append(f"Summary of earlier conversation: {summary}")
+    if history:
+        lines.append(format_lines(history))
+    return "\n".join(lines) + "\n"
+
+
+def empty_memory():
+    # summarized: 已经并入摘要的消息数
+    return {"summary": "", "summarized": 0}
+
+
+class ConversationMemory:
+    # 最近 window_turns 轮原样保留, 更早的轮次增量并入摘要; 每轮 prompt 中的历史长度有上限, 与会话长度无关
+    def __init__(self, llm, window_turns=3, turn_tokens=300, summary_tokens=300):
+        self.window_turns = window_turns
+        self.turn_tokens = turn_tokens
+        self.summary_tokens = summary_tokens
+        self.summary_prompt = ChatPromptTemplate.from_template(SUMMARY_PROMPT_TEMPLATE)
+        self.summary_chain = (self.summary_prompt | llm).with_config(metadata={"llm_call": "memory_summary"})
+
+    def window_start(self, messages):
+        return max(0, len(messages) - 2 * self.window_turns)
+
+    def inputs(self, messages, memory=None):
+        # 返回写入 AgentGraphState 的 history 与 summary
+        memory = memory or empty_memory()
+        history = [
+            {"role": m["role"], "content": truncate_tokens(m["content"], self.turn_tokens)}
+            for m in messages[self.window_start(messages):]
+        ]
+        return {"history": history, "summary": memory["summary"]}
+
+    def pending(self, messages, memory):
+        # 滑出窗口、还没有并入摘要的消息
+        return messages[memory["summarized"]:self.window_start(messages)]
+
+    def summary_inputs(self, memory, evicted):
+        new_lines = format_lines(
+            {"role": m["role"], "content": truncate_tokens(m["content"], self.turn_tokens)} for m in evicted
+        )
+        return {
+            "summary": memory["summary"] or "(empty)",
+            "new_lines": new_lines,
+            "max_words": self.summary_tokens * 3 // 4,
+        }
+
+    def merged(self, memory, evicted, summary):
+        return {
+            "summary": truncate_tokens(summary.strip(), self.summary_tokens),
+            "summarized": memory["summarized"] + len(evicted),
+        }
+
+    def update(self, memory, messages):
+        # 在回答结束后调用; 每次只把新滑出窗口的消息并入摘要, 输入长度有上限
+        memory = memory or empty_memory()
+        evicted = self.pending(messages, memory)
+        if not evicted:
+            return memory
+        with span("memory.summarize", messages=len(evicted)):
+            result = self.summary_chain.invoke(self.summary_inputs(memory, evicted))
+        return self.merged(memory, evicted, result.content)
+
+    async def aupdate(self, memory, messages):
+        memory = memory or empty_memory()
+        evicted = self.pending(messages, memory)
+        if not evicted:
+            return memory
+        with span("memory.summarize", messages=len(evicted)):
+            result = await self.summary_chain.ainvoke(self.summary_inputs(memory, evicted))
+        return self.merged(memory, evicted, result.content)
+
+
+def create_memory(llm):
+    return ConversationMemory(
+        llm,
+        window_turns=int(os.getenv("MEMORY_WINDOW_TURNS", "3")),
+        turn_tokens=int(os.getenv("MEMORY_TURN_TOKENS", "300")),
+        summary_tokens=int(os.getenv("MEMORY_SUMMARY_TOKENS", "300")),
+    )
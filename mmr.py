@@ -0,0 +1,31 @@
+import numpy as np
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def maximal_marginal_relevance(query_vector, candidate_vectors, k=3, lambda_mult=0.5):
+    # 返回 (选中的候选下标, 每个候选与问题的余弦相似度)
+    # 每一步选 lambda * sim(q, d) - (1 - lambda) * max(sim(d, 已选)) 最大的候选
+    candidates = normalize(candidate_vectors)
+    if len(candidates) == 0:
+        return [], np.zeros(0, dtype=np.float32)
+    query_similarity = candidates @ normalize(query_vector)
+    pairwise_similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(query_similarity))]
+    redundancy = pairwise_similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, len(candidates)):
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, pairwise_similarity[best], out=redundancy)
+    return selected, query_similarity
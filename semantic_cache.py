@@ -0,0 +1,173 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from kb_version import current_kb_version
+from tracing import metrics
+
+
+def replay(text, chunk_size=16):
+    # 把缓存的回答按小片段重新输出, 与模型流式输出的体验保持一致
+    for i in range(0, len(text), chunk_size):
+        yield text[i:i + chunk_size]
+
+
+class SemanticCache:
+    def __init__(self, embedding_function, path="knowledge_base/semantic_cache.sqlite",
+                 threshold=0.95, ttl=86_400, max_entries=1_000):
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                question TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                reply TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                kb_version TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+        self._lock = threading.Lock()
+        # id -> (vector, reply, created_at), 按最近使用顺序排列
+        self._entries = OrderedDict()
+        self._matrix = None
+        self._matrix_ids = []
+        self.hits = 0
+        self.misses = 0
+
+        self._kb_version = current_kb_version()
+        self._load()
+
+    def _load(self):
+        now = time.time()
+        self._conn.execute(
+            "DELETE FROM entries WHERE kb_version != ? OR created_at < ?",
+            (self._kb_version, now - self.ttl),
+        )
+        rows = self._conn.execute(
+            "SELECT id, vector, reply, created_at FROM entries ORDER BY last_used DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        self._conn.execute(
+            "DELETE FROM entries WHERE id NOT IN (SELECT id FROM entries ORDER BY last_used DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self._conn.commit()
+        for entry_id, vector, reply, created_at in reversed(rows):
+            self._entries[entry_id] = (np.frombuffer(vector, dtype=np.float32), reply, created_at)
+        self._matrix = None
+
+    def _check_kb_version(self):
+        kb_version = current_kb_version()
+        if kb_version != self._kb_version:
+            self._kb_version = kb_version
+            self._clear()
+
+    def _clear(self):
+        self._entries.clear()
+        self._matrix = None
+        self._conn.execute("DELETE FROM entries")
+        self._conn.commit()
+
+    def _remove(self, entry_ids):
+        for entry_id in entry_ids:
+            self._entries.pop(entry_id, None)
+        self._conn.executemany("DELETE FROM entries WHERE id = ?", [(i,) for i in entry_ids])
+        self._conn.commit()
+        self._matrix = None
+
+    def embed(self, question):
+        vector = np.asarray(self.embedding_function.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    async def aembed(self, question):
+        vector = np.asarray(await self.embedding_function.aembed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _count(self, result):
+        # 命中与未命中次数同时导出到 /metrics, 未命中按原因区分: empty / below_threshold / expired
+        if result == "hit":
+            self.hits += 1
+        else:
+            self.misses += 1
+        metrics.inc("chatbot_cache_lookups_total", help="In-process cache lookups by result", cache="semantic", result=result)
+
+    def lookup(self, vector):
+        with self._lock:
+            self._check_kb_version()
+            if not self._entries:
+                self._count("empty")
+                return None
+            if self._matrix is None:
+                self._matrix_ids = list(self._entries)
+                self._matrix = np.stack([self._entries[i][0] for i in self._matrix_ids])
+
+            similarities = self._matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self._count("below_threshold")
+                return None
+
+            entry_id = self._matrix_ids[best]
+            _, reply, created_at = self._entries[entry_id]
+            now = time.time()
+            if now - created_at > self.ttl:
+                self._remove([entry_id])
+                self._count("expired")
+                return None
+
+            self._entries.move_to_end(entry_id)
+            self._conn.execute("UPDATE entries SET last_used = ? WHERE id = ?", (now, entry_id))
+            self._conn.commit()
+            self._count("hit")
+            return reply
+
+    def store(self, question, vector, reply):
+        if not reply:
+            return
+        with self._lock:
+            self._check_kb_version()
+            now = time.time()
+            cursor = self._conn.execute(
+                "INSERT INTO entries (question, vector, reply, created_at, last_used, kb_version) VALUES (?, ?, ?, ?, ?, ?)",
+                (question, vector.astype(np.float32).tobytes(), reply, now, now, self._kb_version),
+            )
+            self._conn.commit()
+            self._entries[cursor.lastrowid] = (vector.astype(np.float32), reply, now)
+            self._matrix = None
+
+            # LRU 淘汰
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                self._remove(list(self._entries)[:overflow])
+                metrics.inc("chatbot_cache_evictions_total", overflow, help="In-process cache evictions", cache="semantic")
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
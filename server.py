@@ -0,0 +1,212 @@
+import asyncio
+import importlib
+import json
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
+
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from langchain_ollama import ChatOllama
+from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, Field
+
+from balancer import balancer_stats
+from tracing import metrics
+
+load_dotenv()
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
+
+# graph 模块在导入时加载模型与向量库, 放到后台线程里进行; 向量库与各角色的聊天模型都确认可用之前 /readyz 返回 503
+runtime = {"graph": None, "error": None, "probes": {}}
+READY_RETRY_INTERVAL = float(os.getenv("READY_RETRY_INTERVAL", "10"))
+
+
+class Message(BaseModel):
+    role: Literal["user", "assistant"]
+    content: str
+
+
+class Memory(BaseModel):
+    summary: str = ""
+    # 已经并入摘要的消息数
+    summarized: int = Field(0, ge=0)
+
+
+class ChatRequest(BaseModel):
+    question: str
+    # 服务端不保存会话: 客户端发送之前的消息与上次 done 事件返回的 memory; 格式不对时返回 422
+    history: list[Message] = []
+    memory: Optional[Memory] = None
+
+
+def chat_models(graph):
+    return {
+        "router": graph.router_agent.llm,
+        "search_term": graph.retriever_agent.llm,
+        "responder_system_1": graph.responder_agent.system1_model,
+        "responder_system_2": graph.responder_agent.system2_model,
+    }
+
+
+def probe_kwargs(llm):
+    # 只生成 1 个 token, 确认模型已加载且请求链路可用
+    backend = getattr(llm, "backends", [llm])[0]
+    if isinstance(backend, ChatOllama):
+        return {"options": {"num_predict": 1}}
+    if isinstance(backend, ChatOpenAI):
+        return {"max_tokens": 1}
+    return {}
+
+
+async def probe_models(graph):
+    # 多个角色共用同一个客户端时只探测一次
+    llms = {}
+    for role, llm in chat_models(graph).items():
+        llms.setdefault(id(llm), (llm, []))[1].append(role)
+
+    async def probe(llm):
+        start = time.perf_counter()
+        await llm.ainvoke("ping", **probe_kwargs(llm))
+        return time.perf_counter() - start
+
+    seconds = await asyncio.gather(*(probe(llm) for llm, _ in llms.values()))
+    return {role: elapsed for (_, roles), elapsed in zip(llms.values(), seconds) for role in roles}
+
+
+async def check_ready(graph):
+    # 跑一次检索, 确认嵌入模型和向量库都已可用
+    await asyncio.to_thread(graph.retriever_agent.vectorstore.similarity_search, "ping", 1)
+    if graph.model_warmer is not None:
+        results = await asyncio.to_thread(graph.model_warmer.warm_all)
+        failed = sorted(
+            f"{model} at {base_url}"
+            for base_url, models in results.items()
+            for model, result in models.items()
+            if "error" in result
+        )
+        if failed:
+            raise RuntimeError(f"warm-up failed for {', '.join(failed)}")
+    runtime["probes"] = await probe_models(graph)
+
+
+async def load_graph():
+    try:
+        graph = await asyncio.to_thread(importlib.import_module, "graph")
+    except Exception as e:
+        runtime["error"] = repr(e)
+        logger.error("graph 加载失败: %r", e)
+        return
+    # 模型服务可能比本服务晚启动, 检查失败时定期重试
+    while True:
+        try:
+            await check_ready(graph)
+        except Exception as e:
+            runtime["error"] = repr(e)
+            logger.warning("not ready yet, retrying in %.0fs: %r", READY_RETRY_INTERVAL, e)
+            await asyncio.sleep(READY_RETRY_INTERVAL)
+            continue
+        runtime["error"] = None
+        runtime["graph"] = graph
+        return
+
+
+@asynccontextmanager
+async def lifespan(app):
+    loader = asyncio.create_task(load_graph())
+    yield
+    loader.cancel()
+
+
+app = FastAPI(title="Starter Pack Chatbot", lifespan=lifespan)
+
+
+def sse_event(data, event=None):
+    message = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    if event:
+        message = f"event: {event}\n" + message
+    return message
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    if runtime["graph"] is None:
+        return JSONResponse({"ready": False, "error": runtime["error"]}, status_code=503)
+    model_warmer = runtime["graph"].model_warmer
+    return {
+        "ready": True,
+        "probe_seconds": runtime["probes"],
+        "models": model_warmer.stats() if model_warmer is not None else None,
+    }
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    # Prometheus 文本格式; 多 worker 时每个进程各自计数
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/endpoints")
+async def endpoints():
+    # 多端点模型各端点的状态 (熔断/试探/正常)、未完成请求数与延迟
+    return {"balancers": balancer_stats()}
+
+
+@app.post("/chat")
+async def chat(request: ChatRequest):
+    graph = runtime["graph"]
+    if graph is None:
+        return JSONResponse({"error": "not ready"}, status_code=503)
+
+    memory = graph.conversation_memory
+    history = [m.model_dump() for m in request.history]
+    previous = request.memory.model_dump() if request.memory is not None else None
+    inputs = memory.inputs(history, previous)
+
+    async def events():
+        tokens = []
+        try:
+            async for token in graph.astream_reply(request.question, inputs["history"], inputs["summary"]):
+                if token:
+                    tokens.append(token)
+                    yield sse_event({"token": token})
+        except Exception as e:
+            yield sse_event({"error": repr(e)}, event="error")
+            return
+        messages = history + [
+            {"role": "user", "content": request.question},
+            {"role": "assistant", "content": "".join(tokens)},
+        ]
+        try:
+            updated = await memory.aupdate(previous, messages)
+        except Exception as e:
+            # 摘要失败不影响本次回答, 客户端沿用旧的 memory, 下一轮再试
+            logger.warning("conversation summary failed: %r", e)
+            updated = previous
+        yield sse_event({"memory": updated}, event="done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "server:app",
+        host=os.getenv("SERVER_HOST", "0.0.0.0"),
+        port=int(os.getenv("SERVER_PORT", "8000")),
+        workers=int(os.getenv("SERVER_WORKERS", "1")),
+    )
@@ -1,12 +1,17 @@
+import threading
 from typing import TypedDict
 
 
 class AgentGraphState(TypedDict):
     question: str
+    history: list
+    summary: str
     router_need_retriever: bool
     router_need_retriever_reason: str
     router_need_system_2: bool
     router_need_system_2_reason: str
     search_terms: str
+    retrieved_passages: list
     retrieved_info: str
     responder_reply: str
+    cancel_retrieval: threading.Event
@@ -0,0 +1,320 @@
+import asyncio
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+from dotenv import load_dotenv
+from langchain_core.callbacks import BaseCallbackHandler
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "true").lower() == "true"
+TRACE_LOG_PATH = Path(os.getenv("TRACE_LOG_PATH", "logs/traces.jsonl"))
+TRACE_LOG_MAX_BYTES = int(os.getenv("TRACE_LOG_MAX_MB", "10")) * 1024 * 1024
+TRACE_LOG_BACKUPS = int(os.getenv("TRACE_LOG_BACKUPS", "5"))
+# Ollama 报告的模型加载时间超过该值 (秒) 时, 这次调用算作冷启动
+COLD_LOAD_SECONDS = float(os.getenv("TRACE_COLD_LOAD_SECONDS", "0.5"))
+
+# 秒, 覆盖从向量检索 (毫秒级) 到 system 2 推理 (分钟级)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 64, 256, 1024, 4096, 16384)
+# 0 到 1 之间的分数, 例如检索相似度
+SCORE_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    items = ",".join(f'{k}="{str(v)}"'.replace("\n", " ") for k, v in labels)
+    return "{" + items + "}"
+
+
+class Metrics:
+    # 进程内的计数器与直方图, 以 Prometheus 文本格式导出
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> (buckets, {labels: [bucket_counts, sum, count]})
+        self.help = {}
+
+    def inc(self, name, value=1, help="", **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.help.setdefault(name, help)
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, help="", **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.help.setdefault(name, help)
+            buckets, series = self.histograms.setdefault(name, (buckets, {}))
+            entry = series.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            index = bisect.bisect_left(buckets, value)
+            if index < len(buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                if self.help.get(name):
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, (buckets, series) in sorted(self.histograms.items()):
+                if self.help.get(name):
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, (bucket_counts, total, count) in sorted(series.items()):
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets, bucket_counts):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {total}")
+                    lines.append(f"{name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+_trace_logger = None
+_trace_logger_lock = threading.Lock()
+
+
+def trace_logger():
+    # 每条请求一行 JSON, 文件超过上限后轮转
+    global _trace_logger
+    with _trace_logger_lock:
+        if _trace_logger is None:
+            TRACE_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+            handler = RotatingFileHandler(
+                TRACE_LOG_PATH, maxBytes=TRACE_LOG_MAX_BYTES, backupCount=TRACE_LOG_BACKUPS, encoding="utf-8"
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _trace_logger = logging.getLogger("tracing.records")
+            _trace_logger.setLevel(logging.INFO)
+            _trace_logger.propagate = False
+            _trace_logger.addHandler(handler)
+        return _trace_logger
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    # 记录每次 LLM 调用的耗时、首 token 时间与 token 数, 调用名来自 metadata["llm_call"]
+    run_inline = True
+
+    def __init__(self, trace):
+        self.trace = trace
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        name = (metadata or {}).get("llm_call") or kwargs.get("name") or "llm"
+        with self._lock:
+            self._runs[run_id] = {"name": name, "start": time.perf_counter(), "ttft": None}
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self._lock:
+            run = self._runs.get(run_id)
+            if run is not None and run["ttft"] is None:
+                run["ttft"] = time.perf_counter() - run["start"]
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        prompt_tokens, completion_tokens = token_usage(response)
+        self.trace.add_span(
+            run["name"],
+            run["start"],
+            time.perf_counter() - run["start"],
+            kind="llm",
+            ttft=run["ttft"],
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            load_seconds=load_seconds(response),
+        )
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        if isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+            # 调用方主动停止读取 (推测检索被取消 / 路由提前退出), 不算失败
+            self.trace.add_span(
+                run["name"], run["start"], time.perf_counter() - run["start"], kind="llm", ttft=run["ttft"], cancelled=True
+            )
+            return
+        self.trace.add_span(
+            run["name"], run["start"], time.perf_counter() - run["start"], kind="llm", error=repr(error)
+        )
+
+
+def token_usage(response):
+    # Ollama 与 OpenAI 都会在消息的 usage_metadata 中给出 token 数; OpenAI 非流式时也写在 llm_output
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                return usage.get("input_tokens"), usage.get("output_tokens")
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    return usage.get("prompt_tokens"), usage.get("completion_tokens")
+
+
+def load_seconds(response):
+    # Ollama 返回的 load_duration (纳秒): 模型冷启动加载的时间, 服务端排队时也计入这里
+    for generations in response.generations:
+        for generation in generations:
+            info = generation.generation_info or getattr(getattr(generation, "message", None), "response_metadata", None) or {}
+            if info.get("load_duration") is not None:
+                return info["load_duration"] / 1e9
+    return None
+
+
+class Trace:
+    def __init__(self, question=""):
+        self.request_id = uuid.uuid4().hex
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.question_chars = len(question or "")
+        self.spans = []
+        self.ttft = None
+        self.cache_hit = False
+        self.error = None
+        self._lock = threading.Lock()
+        self.callback = TraceCallbackHandler(self)
+
+    def add_span(self, name, start, duration, kind="span", **attrs):
+        span = {
+            "name": name,
+            "kind": kind,
+            "offset": start - self.start,
+            "duration": duration,
+            **{k: v for k, v in attrs.items() if v is not None},
+        }
+        with self._lock:
+            self.spans.append(span)
+
+    def mark_first_token(self):
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self.start
+
+    def record(self):
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["offset"])
+        return {
+            "request_id": self.request_id,
+            "timestamp": self.started_at,
+            "duration": time.perf_counter() - self.start,
+            "ttft": self.ttft,
+            "cache_hit": self.cache_hit,
+            "question_chars": self.question_chars,
+            "error": self.error,
+            "spans": spans,
+        }
+
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+# 每条请求结束时以 record 调用, 例如压测工具收集各节点耗时
+listeners = []
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def start_trace(question=""):
+    # 返回 (trace, token); 图中各节点在复制的上下文中运行, 都能拿到同一个 trace
+    if not TRACE_ENABLED:
+        return None, None
+    trace = Trace(question)
+    return trace, _current_trace.set(trace)
+
+
+def finish_trace(trace, token):
+    if trace is None:
+        return
+    try:
+        _current_trace.reset(token)
+    except ValueError:
+        # 流式生成器可能在另一个上下文中被关闭
+        _current_trace.set(None)
+
+    record = trace.record()
+    status = "error" if record["error"] else "ok"
+    cache = "hit" if record["cache_hit"] else "miss"
+    metrics.inc("chatbot_requests_total", help="Requests by semantic cache result and status", cache=cache, status=status)
+    metrics.observe("chatbot_request_seconds", record["duration"], help="End-to-end request latency", cache=cache)
+    if record["ttft"] is not None:
+        metrics.observe("chatbot_ttft_seconds", record["ttft"], help="Time to first responder token", cache=cache)
+    for span in record["spans"]:
+        if span["kind"] == "llm":
+            observe_llm_span(span)
+        else:
+            metrics.observe("chatbot_span_seconds", span["duration"], help="Wall time of graph nodes and retrieval steps", span=span["name"])
+
+    for listener in listeners:
+        listener(record)
+    try:
+        trace_logger().info(json.dumps(record, ensure_ascii=False))
+    except OSError as e:
+        logger.warning("trace record not written: %r", e)
+
+
+def observe_llm_span(span):
+    call = span["name"]
+    metrics.observe("chatbot_llm_seconds", span["duration"], help="Wall time of LLM calls", call=call)
+    if "ttft" in span:
+        metrics.observe("chatbot_llm_ttft_seconds", span["ttft"], help="Time to first token of streamed LLM calls", call=call)
+    if "load_seconds" in span:
+        metrics.observe("chatbot_llm_load_seconds", span["load_seconds"], help="Model load or server queue time reported by Ollama", call=call)
+        state = "cold" if span["load_seconds"] >= COLD_LOAD_SECONDS else "warm"
+        metrics.inc("chatbot_llm_model_hits_total", help="LLM calls that found the model cold or already loaded", call=call, state=state)
+    if "error" in span:
+        metrics.inc("chatbot_llm_errors_total", help="Failed LLM calls", call=call)
+    if span.get("cancelled"):
+        metrics.inc("chatbot_llm_cancelled_total", help="LLM calls stopped early by the caller", call=call)
+    for kind in ("prompt", "completion"):
+        tokens = span.get(f"{kind}_tokens")
+        if tokens is not None:
+            metrics.inc(f"chatbot_llm_{kind}_tokens_total", tokens, help=f"{kind.capitalize()} tokens", call=call)
+            metrics.observe(f"chatbot_llm_{kind}_tokens", tokens, TOKEN_BUCKETS, help=f"{kind.capitalize()} tokens per call", call=call)
+
+
+@contextmanager
+def span(name, **attrs):
+    # 当前请求没有 trace (例如单独运行某个 agent) 时不做任何记录
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        trace.add_span(name, start, time.perf_counter() - start, error=repr(e), **attrs)
+        raise
+    trace.add_span(name, start, time.perf_counter() - start, **attrs)
+
+
+def trace_config(trace):
+    # 传给 workflow.stream 的 config, 回调会随配置传递到所有嵌套的 LLM 调用
+    if trace is None:
+        return {}
+    return {"callbacks": [trace.callback]}
@@ -0,0 +1,402 @@
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+from dotenv import load_dotenv
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+load_dotenv()
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# 旧版本索引的 meta.json 没有 files 字段, 使用固定文件名
+LEGACY_FILES = {"vectors": "vectors.bin", "scales": "scales.bin", "alive": "alive.bin", "records": "records.jsonl"}
+
+
+def generation_files(generation):
+    return {
+        "vectors": f"vectors.{generation}.bin",
+        "scales": f"scales.{generation}.bin",
+        "alive": f"alive.{generation}.bin",
+        "records": f"records.{generation}.jsonl",
+    }
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _write_atomic(path, data):
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class FlatIndexSnapshot:
+    # 某一代索引的只读视图; 重新加载时整体替换, 正在进行的查询不受影响
+    # records 与 row_of 只追加, 同一进程中 records 文件不变的相邻两代共享它们, 提交时不必重新解析整个 records 文件;
+    # 旧快照只使用自己 count 以内的行
+    def __init__(self, meta, directory, previous=None, appended=()):
+        self.dtype = meta["dtype"]
+        self.dim = meta["dim"]
+        self.count = meta["count"]
+        self.generation = meta["generation"]
+        files = meta.get("files", LEGACY_FILES)
+        self.vectors = None
+        self.scales = None
+        self.alive = np.zeros(0, dtype=bool)
+        self.records = []
+        self.row_of = {}
+        if self.count == 0:
+            return
+
+        self.vectors = np.memmap(
+            directory / files["vectors"], dtype=DTYPES[self.dtype], mode="r", shape=(self.count, self.dim)
+        )
+        if self.dtype == "int8":
+            self.scales = np.memmap(directory / files["scales"], dtype=np.float32, mode="r", shape=(self.count,))
+        self.alive = np.fromfile(directory / files["alive"], dtype=np.uint8, count=self.count).astype(bool)
+        if previous is not None:
+            self.records = previous.records
+            self.row_of = previous.row_of
+            for record in appended:
+                self.row_of[record["id"]] = len(self.records)
+                self.records.append(record)
+            return
+        with open(directory / files["records"], encoding="utf-8") as f:
+            for _, line in zip(range(self.count), f):
+                self.records.append(json.loads(line))
+        self.row_of = {record["id"]: row for row, record in enumerate(self.records)}
+
+    def row(self, record_id):
+        row = self.row_of.get(record_id)
+        return row if row is not None and row < self.count else None
+
+    def document(self, row):
+        record = self.records[row]
+        return Document(page_content=record["text"], metadata=record["metadata"], id=record["id"])
+
+    def float_rows(self, rows):
+        vectors = np.asarray(self.vectors[rows], dtype=np.float32)
+        if self.scales is not None:
+            vectors *= np.asarray(self.scales[rows])[:, None]
+        return vectors
+
+
+class FlatVectorStore(VectorStore):
+    # 子文档向量按行连续存放在内存映射文件中, 多个进程共享同一份操作系统页缓存
+    # 目录结构:
+    #   meta.json           维度、存储类型、行数、代数以及当前使用的数据文件名 (最后写入, 替换 meta.json 即提交)
+    #   vectors.<代>.bin    count x dim 的向量矩阵 (float32 / float16 / int8)
+    #   scales.<代>.bin     int8 量化时每行的缩放系数
+    #   alive.<代>.bin      每行一个字节, 0 表示已删除
+    #   records.<代>.jsonl  每行一个 {"id", "text", "metadata"}, 与向量行一一对应
+    # 追加只写在已提交的行之后; 删除与压缩写入新文件名的文件, 已提交的数据不会被原地修改
+    # 只支持单个写进程 (create_vs.py), 读进程数量不限
+    def __init__(self, embedding_function, persist_directory="knowledge_base/flat_index", dtype="float32",
+                 chunk_rows=65_536):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype: {dtype}. Use 'float32', 'float16' or 'int8'.")
+        self.embedding_function = embedding_function
+        self.directory = Path(persist_directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.requested_dtype = dtype
+        self.chunk_rows = chunk_rows
+        self._lock = threading.RLock()
+        self._meta = None
+        self.snapshot = None
+        self._load()
+
+    @property
+    def embeddings(self):
+        return self.embedding_function
+
+    def _path(self, name):
+        return self.directory / name
+
+    def _read_meta(self):
+        meta_path = self._path("meta.json")
+        try:
+            return json.loads(meta_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return {
+                "dim": 0, "dtype": self.requested_dtype, "count": 0, "records_bytes": 0,
+                "generation": 0, "files": generation_files(0),
+            }
+
+    def _load(self, meta=None, previous=None, appended=()):
+        with self._lock:
+            for _ in range(5):
+                meta = meta or self._read_meta()
+                if meta["count"] == 0:
+                    # 空索引使用当前配置的存储类型
+                    meta["dtype"] = self.requested_dtype
+                    previous = None
+                try:
+                    snapshot = FlatIndexSnapshot(meta, self.directory, previous, appended)
+                    break
+                except FileNotFoundError:
+                    # 读取 meta.json 之后写进程又提交了新一代并删除了旧文件, 重新读取
+                    meta = None
+            else:
+                raise RuntimeError(f"Flat index at {self.directory} keeps changing while loading")
+            self._meta = meta
+            self.snapshot = snapshot
+
+    def _current(self):
+        # 其他进程 (例如 create_vs.py) 提交新一代后自动重新映射; 按 meta.json 中的代数判断, 不依赖文件时间戳的精度
+        meta = self._read_meta()
+        if meta["generation"] != self._meta["generation"]:
+            self._load(meta)
+        return self.snapshot
+
+    def _files(self):
+        return self._meta.get("files", LEGACY_FILES)
+
+    def _file(self, kind):
+        return self._path(self._files()[kind])
+
+    def _write_meta(self, count, dim, records_bytes, files=None, appended=()):
+        # 替换 meta.json 是唯一的提交点; appended 为本次追加的记录, records 文件不变时接在当前快照之后, 不重新解析
+        previous = self._files()
+        meta = {
+            "dim": dim,
+            "dtype": self._meta["dtype"],
+            "count": count,
+            "records_bytes": records_bytes,
+            "generation": self._meta["generation"] + 1,
+            "files": files or previous,
+        }
+        _write_atomic(self._path("meta.json"), json.dumps(meta).encode("utf-8"))
+        snapshot = self.snapshot
+        reuse = meta["files"]["records"] == previous["records"] and 0 < snapshot.count == len(snapshot.records)
+        self._load(meta, snapshot if reuse else None, appended)
+        self._remove_unreferenced()
+
+    def _remove_unreferenced(self):
+        # 删除不再被 meta.json 引用的数据文件 (上一代以及中断的压缩留下的文件)
+        # 已映射旧文件的读进程不受影响, 删除后映射仍然有效
+        current = set(self._files().values())
+        for pattern in ("vectors*.bin", "scales*.bin", "alive*.bin", "records*.jsonl"):
+            for path in self.directory.glob(pattern):
+                if path.name not in current:
+                    try:
+                        path.unlink(missing_ok=True)
+                    except OSError:
+                        # Windows 上仍被映射的文件不能删除, 下次提交时再试
+                        pass
+
+    def _encode(self, vectors, dtype):
+        vectors = _normalize(vectors)
+        if dtype == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0
+            scales[scales == 0] = 1.0
+            return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return vectors.astype(DTYPES[dtype]), None
+
+    def add_vectors(self, vectors, texts, metadatas=None, ids=None):
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        with self._lock:
+            snapshot = self._current()
+            encoded, scales = self._encode(vectors, snapshot.dtype)
+            if snapshot.count and encoded.shape[1] != snapshot.dim:
+                raise ValueError(f"Embedding dimension {encoded.shape[1]} does not match index dimension {snapshot.dim}")
+            self._truncate_uncommitted()
+
+            # 追加写入; 读进程只读取 meta.json 中记录的行数, 所以在更新 meta.json 之前看不到新数据
+            with open(self._file("vectors"), "ab") as f:
+                f.write(encoded.tobytes())
+            if scales is not None:
+                with open(self._file("scales"), "ab") as f:
+                    f.write(scales.tobytes())
+            with open(self._file("alive"), "ab") as f:
+                f.write(np.ones(len(texts), dtype=np.uint8).tobytes())
+            appended = [
+                {"id": record_id, "text": text, "metadata": metadata or {}}
+                for record_id, text, metadata in zip(ids, texts, metadatas)
+            ]
+            records = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in appended).encode("utf-8")
+            with open(self._file("records"), "ab") as f:
+                f.write(records)
+            self._write_meta(
+                snapshot.count + len(texts), encoded.shape[1], self._meta["records_bytes"] + len(records),
+                appended=appended,
+            )
+        return ids
+
+    def _truncate_uncommitted(self):
+        # 上次写入在更新 meta.json 前中断时, 截掉未提交的尾部数据, 保证各文件的行仍然对齐
+        meta = self._meta
+        sizes = {
+            "vectors": meta["count"] * meta["dim"] * np.dtype(DTYPES[meta["dtype"]]).itemsize,
+            "scales": meta["count"] * 4,
+            "alive": meta["count"],
+            "records": meta["records_bytes"],
+        }
+        for kind, size in sizes.items():
+            path = self._file(kind)
+            if path.exists() and path.stat().st_size > size:
+                os.truncate(path, size)
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        return self.add_vectors(self.embedding_function.embed_documents(texts), texts, metadatas, ids)
+
+    async def aadd_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        vectors = await self.embedding_function.aembed_documents(texts)
+        return self.add_vectors(vectors, texts, metadatas, ids)
+
+    def delete(self, ids=None, **kwargs):
+        if not ids:
+            return True
+        with self._lock:
+            snapshot = self._current()
+            alive = snapshot.alive.astype(np.uint8)
+            for record_id in ids:
+                row = snapshot.row(record_id)
+                if row is not None:
+                    alive[row] = 0
+            # 新的删除标记写入下一代的文件名, 读进程看到新的 meta.json 之前仍使用旧文件
+            files = {**self._files(), "alive": generation_files(self._meta["generation"] + 1)["alive"]}
+            _write_atomic(self._path(files["alive"]), alive.tobytes())
+            self._write_meta(snapshot.count, snapshot.dim, self._meta["records_bytes"], files)
+        return True
+
+    def compact(self):
+        # 删除墓碑行; 所有文件写成下一代的新文件, 替换 meta.json 后读进程才会切换过去
+        with self._lock:
+            snapshot = self._current()
+            if snapshot.count == 0 or snapshot.alive.all():
+                return
+            rows = np.flatnonzero(snapshot.alive)
+            files = generation_files(self._meta["generation"] + 1)
+            _write_atomic(self._path(files["vectors"]), np.ascontiguousarray(snapshot.vectors[rows]).tobytes())
+            if snapshot.scales is not None:
+                _write_atomic(self._path(files["scales"]), np.ascontiguousarray(snapshot.scales[rows]).tobytes())
+            _write_atomic(self._path(files["alive"]), np.ones(len(rows), dtype=np.uint8).tobytes())
+            records = "".join(json.dumps(snapshot.records[row], ensure_ascii=False) + "\n" for row in rows)
+            records = records.encode("utf-8")
+            _write_atomic(self._path(files["records"]), records)
+            self._write_meta(len(rows), snapshot.dim, len(records), files)
+
+    def reset_collection(self):
+        with self._lock:
+            self._meta["dtype"] = self.requested_dtype
+            self._write_meta(0, 0, 0, generation_files(self._meta["generation"] + 1))
+
+    def __len__(self):
+        return int(self._current().alive.sum())
+
+    def get(self, ids=None, include=("documents", "metadatas")):
+        # 与 Chroma.get 返回格式一致, create_vs.py 重建 BM25 索引时使用
+        snapshot = self._current()
+        if ids is None:
+            rows = list(np.flatnonzero(snapshot.alive))
+        else:
+            rows = [row for row in map(snapshot.row, ids) if row is not None and snapshot.alive[row]]
+        result = {"ids": [snapshot.records[row]["id"] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [snapshot.records[row]["text"] for row in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [snapshot.records[row]["metadata"] for row in rows]
+        return result
+
+    def search_vectors(self, query_vectors, k=4, snapshot=None):
+        # 批量 top-k: 返回每个查询的 [(行号, 余弦相似度)]
+        snapshot = snapshot or self._current()
+        queries = _normalize(np.atleast_2d(query_vectors))
+        k = min(k, int(snapshot.alive.sum()))
+        if k == 0:
+            return [[] for _ in queries]
+
+        vectors = snapshot.vectors
+        similarity = np.empty((len(queries), len(vectors)), dtype=np.float32)
+        # 分块转换成 float32 计算, float16 / int8 存储时也不会一次性解压整个矩阵
+        for start in range(0, len(vectors), self.chunk_rows):
+            block = np.asarray(vectors[start:start + self.chunk_rows], dtype=np.float32)
+            block_similarity = queries @ block.T
+            if snapshot.scales is not None:
+                block_similarity *= snapshot.scales[start:start + self.chunk_rows]
+            similarity[:, start:start + len(block)] = block_similarity
+        similarity[:, ~snapshot.alive] = -np.inf
+
+        top = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+        results = []
+        for query_index, rows in enumerate(top):
+            rows = rows[np.argsort(-similarity[query_index, rows])]
+            results.append([(int(row), float(similarity[query_index, row])) for row in rows])
+        return results
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4):
+        snapshot = self._current()
+        return [(snapshot.document(row), score) for row, score in self.search_vectors(embedding, k, snapshot)[0]]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self.embedding_function.embed_query(query), k)
+
+    async def asimilarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(await self.embedding_function.aembed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    async def asimilarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in await self.asimilarity_search_with_score(query, k)]
+
+    def similarity_search_with_vectors(self, embedding, k=4):
+        # MMR 重排使用: 返回候选子文档及其存储的向量
+        snapshot = self._current()
+        rows = [row for row, _ in self.search_vectors(embedding, k, snapshot)[0]]
+        if not rows:
+            return [], np.zeros((0, snapshot.dim), dtype=np.float32)
+        return [snapshot.document(row) for row in rows], snapshot.float_rows(rows)
+
+    def _select_relevance_score_fn(self):
+        # 余弦相似度 [-1, 1] 映射到 [0, 1]
+        return lambda score: min(1.0, max(0.0, (score + 1) / 2))
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, **kwargs):
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+
+def create_vectorstore(embedding_function, backend=None):
+    backend = (backend or os.getenv("VECTORSTORE_BACKEND", "chroma")).lower()
+    if backend == "chroma":
+        return Chroma(
+            collection_name="parent_docs",
+            embedding_function=embedding_function,
+            persist_directory=os.getenv("VECTORSTORE_PATH", "knowledge_base/vectorstore"),
+        )
+    if backend == "flat":
+        return FlatVectorStore(
+            embedding_function,
+            persist_directory=os.getenv("FLAT_INDEX_PATH", "knowledge_base/flat_index"),
+            dtype=os.getenv("FLAT_INDEX_DTYPE", "float32"),
+        )
+    raise ValueError(f"Unsupported vectorstore backend: {backend}. Use 'chroma' or 'flat'.")
+
+
+def count_vectors(vectorstore):
+    if isinstance(vectorstore, FlatVectorStore):
+        return len(vectorstore)
+    return vectorstore._collection.count()
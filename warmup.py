@@ -0,0 +1,215 @@
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+import httpx
+from dotenv import load_dotenv
+from langchain_ollama import ChatOllama, OllamaEmbeddings
+
+from tracing import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_keep_alive(value):
+    # Ollama 的 keep_alive: 秒数或 "30m" / "1h30m" 这样的时长; 负数表示常驻内存
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip()
+    if re.fullmatch(r"-?\d+", value):
+        return int(value)
+    parts = DURATION_PATTERN.findall(value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        raise ValueError(f"Unsupported keep_alive: {value}. Use seconds or a duration like '30m'.")
+    return int(sum(float(number) * DURATION_UNITS[unit] for number, unit in parts))
+
+
+def parse_expires_at(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def model_tag(model):
+    # /api/ps 返回带标签的名字, 未写标签的模型即 latest
+    return model if ":" in model else f"{model}:latest"
+
+
+def ollama_models(*agents):
+    # 从 agent 实例中找出所有 Ollama 模型 (含嵌入模型), 返回 {(base_url, model): {"kind", "clients"}}
+    models = {}
+
+    def visit(value):
+        if isinstance(value, ChatOllama):
+            key = (value.base_url or "http://localhost:11434", value.model)
+            models.setdefault(key, {"kind": "chat", "clients": []})["clients"].append(value)
+        elif isinstance(value, OllamaEmbeddings):
+            key = (value.base_url or "http://localhost:11434", value.model)
+            models.setdefault(key, {"kind": "embed", "clients": []})["clients"].append(value)
+        elif hasattr(value, "backends"):
+            # 负载均衡包装: 每个端点上的模型都要预热
+            for backend in value.backends:
+                visit(backend)
+        elif hasattr(value, "embeddings"):
+            # CachedEmbeddings 包装的底层嵌入模型
+            visit(value.embeddings)
+
+    for agent in agents:
+        for value in vars(agent).values():
+            visit(value)
+    return models
+
+
+class ModelWarmer:
+    # 启动时预加载所有 Ollama 模型, 固定 keep_alive, 并在模型被卸载前定期重新预热
+    def __init__(self, models, keep_alive="30m", interval=None, timeout=600.0):
+        self.models = models
+        self.keep_alive = parse_keep_alive(keep_alive)
+        # 默认在 keep_alive 过去一半时检查一次; keep_alive 为负 (常驻) 时每 5 分钟确认一次仍已加载
+        self.interval = interval or (self.keep_alive / 2 if self.keep_alive > 0 else 300)
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.status = {}
+        for info in models.values():
+            for client in info["clients"]:
+                # 之后的每次请求都带上相同的 keep_alive, 否则 Ollama 会按默认的 5 分钟卸载
+                client.keep_alive = self.keep_alive
+
+    @classmethod
+    def from_agents(cls, *agents, **kwargs):
+        return cls(ollama_models(*agents), **kwargs)
+
+    def loaded_models(self, base_url):
+        # /api/ps: 当前已加载的模型及其到期时间
+        response = httpx.get(f"{base_url}/api/ps", timeout=10)
+        response.raise_for_status()
+        return {
+            model_tag(m.get("model") or m.get("name")): parse_expires_at(m.get("expires_at"))
+            for m in response.json().get("models", [])
+        }
+
+    def load(self, base_url, model, kind):
+        # 空 prompt 的 generate 只加载模型; 嵌入模型用一次很短的 embed 请求
+        if kind == "embed":
+            body = {"model": model, "input": "warmup", "keep_alive": self.keep_alive}
+            response = httpx.post(f"{base_url}/api/embed", json=body, timeout=self.timeout)
+        else:
+            body = {"model": model, "keep_alive": self.keep_alive}
+            response = httpx.post(f"{base_url}/api/generate", json=body, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json().get("load_duration")
+
+    def due(self, expires_at, now):
+        # 下次检查之前就会到期的模型需要现在刷新
+        if self.keep_alive < 0:
+            return False
+        return expires_at is None or expires_at - now <= self.interval * 1.5
+
+    def warm(self, base_url, model, kind, loaded):
+        now = time.time()
+        state = "warm" if model_tag(model) in loaded else "cold"
+        if state == "warm" and not self.due(loaded[model_tag(model)], now):
+            return state, 0.0
+        start = time.perf_counter()
+        load_duration = self.load(base_url, model, kind)
+        elapsed = time.perf_counter() - start
+        metrics.inc("chatbot_model_warmups_total", help="Warm-up requests by model state before warm-up", model=model, state=state)
+        metrics.observe("chatbot_model_warmup_seconds", elapsed, help="Warm-up request latency", model=model, state=state)
+        if load_duration:
+            metrics.observe("chatbot_model_load_seconds", load_duration / 1e9, help="Model load time reported by Ollama", model=model)
+        return state, elapsed
+
+    def warm_all(self):
+        # 按服务器分组返回 {base_url: {model: 结果}}; 同一个模型可能部署在多个端点上, 每个端点的结果分开记录
+        results = {}
+        by_server = {}
+        for (base_url, model), info in self.models.items():
+            by_server.setdefault(base_url, []).append((model, info["kind"]))
+        for base_url, models in by_server.items():
+            server = results[base_url] = {}
+            try:
+                loaded = self.loaded_models(base_url)
+            except httpx.HTTPError as e:
+                logger.warning("warm-up: %s unavailable: %r", base_url, e)
+                for model, _ in models:
+                    server[model] = {"error": repr(e)}
+                continue
+            for model, kind in models:
+                try:
+                    state, elapsed = self.warm(base_url, model, kind, loaded)
+                    server[model] = {"state": state, "seconds": elapsed}
+                except httpx.HTTPError as e:
+                    logger.warning("warm-up of %s at %s failed: %r", model, base_url, e)
+                    metrics.inc("chatbot_model_warmup_errors_total", help="Failed warm-up requests", model=model, endpoint=base_url)
+                    server[model] = {"error": repr(e)}
+        with self._lock:
+            self.status = {"checked_at": time.time(), "models": results}
+        return results
+
+    def run(self):
+        while not self._stop.is_set():
+            self.warm_all()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        # 后台线程: 立即预热一次, 之后每 interval 秒检查一次
+        if self._thread is None and self.models:
+            self._thread = threading.Thread(target=self.run, name="model-warmer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.status)
+
+
+def create_model_warmer(*agents):
+    if os.getenv("WARMUP_ENABLED", "false").lower() != "true":
+        return None
+    interval = os.getenv("WARMUP_INTERVAL")
+    return ModelWarmer.from_agents(
+        *agents,
+        keep_alive=os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+        interval=float(interval) if interval else None,
+    )
+
+
+if __name__ == "__main__":
+    # python warmup.py            预热一次并打印各模型状态
+    # python warmup.py --watch    持续运行, 定期重新预热
+    parser = argparse.ArgumentParser(description="预加载并保持 Ollama 模型常驻")
+    parser.add_argument("--watch", action="store_true")
+    parser.add_argument("--keep-alive", default=os.getenv("OLLAMA_KEEP_ALIVE", "30m"))
+    parser.add_argument("--interval", type=float, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+
+    from agents.responder import ResponderAgent
+    from agents.retriever import RetrieverAgent
+    from agents.router import RouterAgent
+
+    model_warmer = ModelWarmer.from_agents(
+        RouterAgent(), RetrieverAgent(), ResponderAgent(), keep_alive=args.keep_alive, interval=args.interval
+    )
+    if args.watch:
+        model_warmer.run()
+    else:
+        print(json.dumps(model_warmer.warm_all(), indent=2))